@@ -0,0 +1,344 @@
+import os
+import csv
+import sys
+import gzip
+import json
+import time
+import zlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'validate_sitemap_links.py')
+SITEMAP_NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+# each scenario runs validate_sitemap_links.py against the mock site with these settings
+SCENARIOS = {
+    'sequential': {'sitemap': 'sitemap.xml', 'config': {'max_workers': 1}},
+    'concurrent': {'sitemap': 'sitemap.xml',
+                   'config': {'max_workers': 16, 'max_workers_per_host': 8}},
+    'sitemap_index': {'sitemap': 'sitemap_index.xml',
+                      'config': {'max_workers': 16, 'max_workers_per_host': 8}},
+    'sitemap_gzip': {'sitemap': 'sitemap.xml.gz',
+                     'config': {'max_workers': 16, 'max_workers_per_host': 8}},
+    'bs4_parser': {'sitemap': 'sitemap.xml',
+                   'config': {'max_workers': 16, 'max_workers_per_host': 8,
+                              'html_parser': 'html.parser'}},
+    'probe_third_party': {'sitemap': 'sitemap.xml',
+                          'config': {'max_workers': 16, 'max_workers_per_host': 8,
+                                     'probe_mode': {'third_party': 'head'}}},
+    'parse_workers': {'sitemap': 'sitemap.xml',
+                      'config': {'max_workers': 16, 'max_workers_per_host': 8,
+                                 'parse_workers': 4}},
+    'cached_rerun': {'sitemap': 'sitemap.xml', 'runs': 2,
+                     'config': {'max_workers': 16, 'max_workers_per_host': 8,
+                                'cache_file': 'cache.sqlite', 'cache_ttl': 3600}},
+    'validate_url': {'sitemap': 'sitemap.xml', 'function': 'validate_url', 'config': {}}
+}
+
+
+class MockSiteHandler(BaseHTTPRequestHandler):
+    """Serves a synthetic site: flat, indexed and gzipped sitemaps and N generated pages.
+
+    Pages live at /pages/<n>.html and link to fanout other pages. Every third link points to the
+    same page through the third-party host name, so links are a mix of first and third party.
+    Pages support HEAD, ETag/If-None-Match and fail deterministically at the configured error
+    rate. Every response is delayed by the configured latency."""
+    protocol_version = 'HTTP/1.1'
+    site = None
+
+    def do_GET(self):
+        self.respond(include_body=True)
+
+    def do_HEAD(self):
+        self.respond(include_body=False)
+
+    def respond(self, include_body):
+        site = self.site
+        time.sleep(site['latency'])
+        path = self.path.split('?')[0]
+        status, content_type, headers = 200, 'text/html; charset=utf-8', {}
+        if path == '/sitemap.xml':
+            body, content_type = self.urlset(range(site['pages'])), 'application/xml'
+        elif path == '/sitemap.xml.gz':
+            body, content_type = gzip.compress(self.urlset(range(site['pages']))), 'application/gzip'
+        elif path == '/sitemap_index.xml':
+            body, content_type = self.sitemap_index(), 'application/xml'
+        elif path.startswith('/sitemaps/') and path.endswith('.xml'):
+            index = int(path[len('/sitemaps/'):-len('.xml')])
+            size = site['sitemap_size']
+            body = self.urlset(range(index * size, min((index + 1) * size, site['pages'])))
+            content_type = 'application/xml'
+        elif path.startswith('/pages/') and path.endswith('.html'):
+            page = int(path[len('/pages/'):-len('.html')])
+            status = self.page_status(page)
+            etag = f'"{page}"'
+            headers['ETag'] = etag
+            if status == 200 and self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+            else:
+                body = self.page(page, status)
+        else:
+            status, body = 404, b'<html><head><title>Not Found</title></head><body></body></html>'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if include_body and status != 304:
+            self.wfile.write(body)
+
+    def page_status(self, page):
+        """Return the status of the page; pages fail deterministically at the error rate."""
+        if self.site['error_rate'] and zlib.crc32(str(page).encode()) % 10000 < self.site['error_rate'] * 10000:
+            return 500 if page % 2 else 404
+        return 200
+
+    def page(self, page, status):
+        site = self.site
+        links = []
+        for offset in range(1, site['fanout'] + 1):
+            target = (page * 7 + offset) % (site['pages'] + site['orphans'])
+            host = site['third_party_host'] if offset % 3 == 0 else site['host']
+            links.append(f'<li><a href="http://{host}/pages/{target}.html">Page {target}</a></li>')
+        paragraph = '<p>' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20 + '</p>'
+        return (f'<!DOCTYPE html><html><head><title>Page {page} ({status})</title></head><body>'
+                f'<nav><ul>{"".join(links)}</ul></nav>{paragraph * site["paragraphs"]}'
+                f'</body></html>').encode('utf-8')
+
+    def urlset(self, pages):
+        host = self.site['host']
+        locs = ''.join(f'<url><loc>http://{host}/pages/{page}.html</loc></url>' for page in pages)
+        return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{SITEMAP_NAMESPACE}">{locs}</urlset>'.encode()
+
+    def sitemap_index(self):
+        site = self.site
+        count = -(-site['pages'] // site['sitemap_size'])
+        locs = ''.join(f'<sitemap><loc>http://{site["host"]}/sitemaps/{index}.xml</loc></sitemap>'
+                       for index in range(count))
+        return (f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{SITEMAP_NAMESPACE}">'
+                f'{locs}</sitemapindex>').encode()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_site(pages=1000, latency=0.0, error_rate=0.0, fanout=10, orphans=0,
+                    sitemap_size=500, paragraphs=5, port=0):
+    """Start the mock site in a background thread and return the server and its settings."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockSiteHandler)
+    server.daemon_threads = True
+    port = server.server_address[1]
+    MockSiteHandler.site = {
+        'pages': pages, 'latency': latency, 'error_rate': error_rate, 'fanout': fanout,
+        'orphans': orphans, 'sitemap_size': sitemap_size, 'paragraphs': paragraphs,
+        'host': f'127.0.0.1:{port}', 'third_party_host': f'localhost:{port}'
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'Mock site with {pages} pages running at http://127.0.0.1:{port}/')
+    return server, MockSiteHandler.site
+
+
+class ProcessGroupMonitor:
+    """Samples the CPU time and RSS of every process in a process group from /proc, so that the
+    processes started by the child (such as the parse_workers pool) are measured too."""
+
+    def __init__(self, pgid, interval=0.05):
+        self.pgid = pgid
+        self.interval = interval
+        self.peak_rss = 0.0
+        self._cpu_times = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def cpu_time(self):
+        """The CPU seconds used by the processes of the group, as last sampled."""
+        return sum(self._cpu_times.values())
+
+    def start(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """Wait for the rest of the group to exit (up to timeout seconds) and stop sampling."""
+        if self._thread.is_alive():
+            deadline = time.monotonic() + timeout
+            while self._sample() and time.monotonic() < deadline:
+                time.sleep(self.interval)
+            self._stopped.set()
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        """Record the CPU time of each process of the group and the sum of their RSS, and
+        return the number of processes found."""
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        count = 0
+        rss = 0
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as file:
+                    fields = file.read().rsplit(')', 1)[1].split()
+                if int(fields[2]) != self.pgid or fields[0] == 'Z':
+                    continue
+                with open(f'/proc/{entry}/statm') as file:
+                    rss += int(file.read().split()[1]) * page_size
+            except (OSError, IndexError, ValueError):
+                continue
+            count += 1
+            self._cpu_times[entry] = (int(fields[11]) + int(fields[12])) / clock_ticks
+        self.peak_rss = max(self.peak_rss, rss / 1048576)
+        return count
+
+
+def run_child(command, cwd):
+    """Run the command and return its wall time, CPU time and peak RSS (in MB), including the
+    processes it starts."""
+    start = time.monotonic()
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    monitor = ProcessGroupMonitor(process.pid)
+    monitor.start()
+    _, status, usage = os.wait4(process.pid, 0)
+    monitor.stop()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.monotonic() - start
+    if process.returncode:
+        raise RuntimeError(f'{command} exited with status {process.returncode}')
+    # wait4 covers the child and the processes it waited for, the monitor also covers the rest
+    return (wall_time, max(usage.ru_utime + usage.ru_stime, monitor.cpu_time),
+            max(usage.ru_maxrss / 1024, monitor.peak_rss))
+
+
+def count_rows(data_file):
+    """Count the result rows (excluding the header) in the CSV file."""
+    with open(data_file, newline='') as file:
+        return max(sum(1 for _ in csv.reader(file)) - 1, 0)
+
+
+def run_scenario(name, scenario, site, workdir):
+    """Run the scenario against the mock site and return its measurements."""
+    config = {
+        'sitemap_url': f'http://{site["host"]}/{scenario["sitemap"]}',
+        'first_party_domains': [site['host']],
+        'timeout': 10,
+        'extract_additional_urls': True,
+        'data_file': os.path.join(workdir, f'{name}.csv'),
+        'max_retries': 0,
+        **scenario['config']
+    }
+    if 'cache_file' in config:
+        config['cache_file'] = os.path.join(workdir, f'{name}_{config["cache_file"]}')
+    config_file = os.path.join(workdir, f'{name}.json')
+    with open(config_file, 'w') as file:
+        json.dump(config, file)
+
+    if scenario.get('function') == 'validate_url':
+        command = [sys.executable, os.path.abspath(__file__), '--validate-url-worker', config_file]
+    else:
+        command = [sys.executable, SCRIPT, '--config', config_file]
+
+    # only the last run is measured, so earlier runs can warm up caches
+    for _ in range(scenario.get('runs', 1)):
+        wall_time, cpu_time, peak_rss = run_child(command, workdir)
+    urls = count_rows(config['data_file'])
+    result = {
+        'scenario': name,
+        'urls': urls,
+        'wall_seconds': round(wall_time, 3),
+        'urls_per_second': round(urls / wall_time, 1) if wall_time else 0.0,
+        'cpu_seconds': round(cpu_time, 3),
+        'peak_rss_mb': round(peak_rss, 1)
+    }
+    logging.info(f'Scenario {name}: {result["urls"]} URLs, {result["urls_per_second"]} URLs/sec, '
+                 f'{result["cpu_seconds"]} CPU seconds, {result["peak_rss_mb"]} MB peak RSS.')
+    return result
+
+
+def validate_url_worker(config_file):
+    """Validate every sitemap URL with validate_url directly, without the engine or writer."""
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    import validate_sitemap_links as vsl
+
+    logging.getLogger().setLevel(logging.WARNING)
+    config = vsl.load_config(config_file)
+    session = vsl.PooledSession(max_retries=0)
+    urls_to_exclude = vsl.PatternMatcher(config.get('urls_to_exclude', []))
+    phrases_to_exclude = vsl.PatternMatcher(config.get('phrases_to_exclude', []))
+    with vsl.ResultWriter(config['data_file']) as writer:
+        for url in vsl.iter_sitemap_urls(config['sitemap_url'], config['timeout'], session):
+            data = vsl.validate_url(url, urls_to_exclude, phrases_to_exclude,
+                                    config['first_party_domains'], config['timeout'],
+                                    extract_urls=True, session=session)
+            data.pop('additional_urls', None)
+            data.pop('timings', None)
+            vsl.write_data(writer, link_text=url, source_url=config['sitemap_url'], **data)
+    session.close()
+
+
+def print_report(results):
+    """Print the benchmark results as a table."""
+    columns = ['scenario', 'urls', 'wall_seconds', 'urls_per_second', 'cpu_seconds', 'peak_rss_mb']
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    """Main entry point for the benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark validate_sitemap_links.py against a local mock site.')
+    parser.add_argument('--pages', type=int, default=500, help='Number of pages in the sitemap.')
+    parser.add_argument('--latency', type=float, default=0.005, help='Delay (in seconds) of every response.')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='Fraction of pages that return 404/500.')
+    parser.add_argument('--fanout', type=int, default=10, help='Number of links on each page.')
+    parser.add_argument('--orphans', type=int, default=50,
+                        help='Number of linked pages that are not in the sitemap.')
+    parser.add_argument('--sitemap-size', type=int, default=100,
+                        help='Number of URLs per child sitemap of the sitemap index.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS),
+                        help='Scenarios to run (default is all of them).')
+    parser.add_argument('--output', help='Path of a JSON file to write the results to.')
+    parser.add_argument('--validate-url-worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.validate_url_worker:
+        validate_url_worker(args.validate_url_worker)
+        return
+
+    server, site = start_mock_site(pages=args.pages, latency=args.latency,
+                                   error_rate=args.error_rate, fanout=args.fanout,
+                                   orphans=args.orphans, sitemap_size=args.sitemap_size)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='link_benchmark_') as workdir:
+            for name in args.scenarios:
+                results.append(run_scenario(name, SCENARIOS[name], site, workdir))
+    finally:
+        server.shutdown()
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+        logging.info(f'Benchmark results written to: {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,938 @@
+import io
+import os
+import copy
 import re
 import csv
 import sys
+import gzip
+import html
 import json
+import zlib
+import time
+import sqlite3
+import heapq
+import hashlib
 import logging
+import multiprocessing
+import tempfile
 import requests
 import argparse
+import threading
+from array import array
+import lxml.html
+from lxml import etree
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from functools import partial, wraps
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.robotparser import RobotFileParser
+from collections import Counter, OrderedDict, defaultdict, deque
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
 
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RESULT_COLUMNS = {
+    'url': 'URL',
+    'response_code': 'Response Code',
+    'exception': 'Exception',
+    'details': 'Details',
+    'response_length': 'Response Length',
+    'page_title': 'Page Title',
+    'url_first_party': 'First Party',
+    'link_text': 'Link Text',
+    'source_url': 'Source URL'
+}
+DATA_FORMATS = ('csv', 'csv.gz', 'jsonl')
+HTML_PARSERS = ('lxml', 'html.parser')
+PROBE_MODES = ('get', 'head')
+TITLE_PATTERN = re.compile(rb'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+# a numbered (\\1) or named ((?P=name)) backreference, not preceded by an escaped backslash
+BACKREFERENCE_PATTERN = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?P=')
+CHARSET_PATTERN = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+TIMING_PHASES = ('connect', 'tls', 'ttfb', 'download', 'parse', 'exclusion', 'total')
+TIMING_COLUMNS = {
+    'connect_time': 'Connect Time',
+    'tls_time': 'TLS Time',
+    'ttfb_time': 'Time to First Byte',
+    'download_time': 'Download Time',
+    'parse_time': 'Parse Time',
+    'exclusion_time': 'Exclusion Time',
+    'total_time': 'Total Time'
+}
+METRICS_FORMATS = ('json', 'prometheus')
+# seconds to wait before checking again whether a host's robots.txt has been read
+ROBOTS_POLL_INTERVAL = 0.05
+PERMANENT_REDIRECT_CODES = (301, 308)
+REDIRECT_COLUMNS = {
+    'redirect_count': 'Redirect Count',
+    'final_url': 'Final URL'
+}
+REDIRECT_REPORT_COLUMNS = {
+    'source_url': 'Source URL',
+    'link_text': 'Link Text',
+    'url': 'URL',
+    'redirect_codes': 'Redirect Codes',
+    'redirect_count': 'Redirect Count',
+    'final_url': 'Final URL'
+}
 
-def write_data(data_file, url, response_code, exception, details, response_length,
-               page_title, url_first_party, link_text, source_url):
-    """Write the results to the CSV file."""
-    with open(data_file, mode='a', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow([url, response_code, exception, details, response_length,
-                         page_title, url_first_party, link_text, source_url])
+# per-thread timings of the URL currently being validated, see start_timing()
+_timings = threading.local()
+# phrase matchers installed in a ParsePool worker process, see init_parse_worker()
+_worker_phrase_matchers = {}
+# number of connections (including reconnects) opened by the timed connection classes
+_connections_opened = [0]
+_connections_opened_lock = threading.Lock()
+
+
+def start_timing():
+    """Start collecting per-phase timings for the current thread."""
+    _timings.phases = {}
+
+
+def stop_timing():
+    """Stop collecting timings for the current thread and return them as a dict of seconds."""
+    phases, _timings.phases = getattr(_timings, 'phases', None) or {}, None
+    return phases
+
+
+def record_timing(phase, seconds):
+    """Add the seconds spent in the phase to the current thread's timings, if they are collected."""
+    phases = getattr(_timings, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + seconds
+
+
+def record_bytes_read(count):
+    """Add the number of response body bytes read to the current thread's timings, as bytes_read."""
+    record_timing('bytes_read', count)
+
+
+@contextmanager
+def timed(phase):
+    """Record the time spent in the with block as the given phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(phase, time.perf_counter() - start)
+
+
+def record_response_timing(response, start):
+    """Split the time since start into time to first byte (excluding the time spent connecting)
+    and body download, using the time requests took to receive the response headers."""
+    phases = getattr(_timings, 'phases', None)
+    if phases is None or response is None:
+        return
+    headers_time = response.elapsed.total_seconds()
+    record_timing('ttfb', max(0.0, headers_time - phases.get('connect', 0) - phases.get('tls', 0)))
+    record_timing('download', max(0.0, time.perf_counter() - start - headers_time))
+
+
+def collect_timings(func):
+    """Decorator that collects the per-phase timings of the call (see timed()) and adds them,
+    along with the total time, to the returned data dict as 'timings'."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start_timing()
+        start = time.perf_counter()
+        try:
+            data = func(*args, **kwargs)
+        finally:
+            timings = stop_timing()
+        timings['total'] = time.perf_counter() - start
+        data['timings'] = timings
+        return data
+    return wrapper
+
+
+def count_connection():
+    """Add one to the number of connections opened."""
+    with _connections_opened_lock:
+        _connections_opened[0] += 1
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """HTTP connection that records the time spent connecting (DNS lookup and TCP handshake)."""
+
+    def _new_conn(self):
+        count_connection()
+        with timed('connect'):
+            return super()._new_conn()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that records the time spent connecting and in the TLS handshake."""
+
+    def _new_conn(self):
+        count_connection()
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        self._connect_time = time.perf_counter() - start
+        record_timing('connect', self._connect_time)
+        return sock
+
+    def connect(self):
+        self._connect_time = 0
+        start = time.perf_counter()
+        super().connect()
+        record_timing('tls', time.perf_counter() - start - self._connect_time)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class CappedRetry(Retry):
+    """Retry that waits at most backoff_max seconds for a Retry-After header, so a worker
+    isn't held up for as long as the server asks."""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.backoff_max)
+
+
+class PooledSession(requests.Session):
+    """A requests Session that keeps connections alive per host and retries transient errors.
+    If a RedirectCache is given, cached permanent redirects are skipped."""
+
+    def __init__(self, pool_connections=100, pool_maxsize=10, max_retries=3, backoff_factor=0.5,
+                 max_retry_wait=30, redirects=None):
+        super().__init__()
+        self.redirects = redirects
+        retry = CappedRetry(total=max_retries, backoff_factor=backoff_factor,
+                            backoff_max=max_retry_wait, status_forcelist=RETRY_STATUS_CODES,
+                            respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=retry)
+        adapter.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                      'https': TimedHTTPSConnectionPool}
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.hooks['response'].append(self._count_retries)
+        self._retries = 0
+        self._retries_lock = threading.Lock()
+        self._connections_baseline = _connections_opened[0]
+
+    def get_redirect_target(self, response):
+        """Return the URL the response redirects to, skipping the cached permanent redirects
+        from there on. The skipped hops are kept on the response as skipped_redirects."""
+        target = super().get_redirect_target(response)
+        if target and self.redirects:
+            resolved, hops = self.redirects.resolve(urljoin(response.url, target))
+            if hops:
+                response.skipped_redirects = hops
+                return resolved
+        return target
+
+    def _count_retries(self, response, *args, **kwargs):
+        """Add the retries urllib3 made for this response to the retry counter."""
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            with self._retries_lock:
+                self._retries += len(retries.history)
+
+    def stats(self):
+        """Return the connection reuse and retry counters for this session."""
+        requests_sent = 0
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+        connections = _connections_opened[0] - self._connections_baseline
+        return {
+            'requests': requests_sent,
+            'connections_opened': connections,
+            'connections_reused': max(requests_sent - connections, 0),
+            'retries': self._retries
+        }
+
+
+class TokenBucket:
+    """Thread-safe token bucket that allows rate requests per second, with bursts of up to burst."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is available and return 0, otherwise return the seconds until one is."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class HostRateLimiter:
+    """Token bucket per host, at the host_rates rate for the domain (or the default rate),
+    limited by the crawl delay in robots.txt if respect_robots_txt is True."""
+
+    def __init__(self, rate=None, burst=1, host_rates=None, respect_robots_txt=False,
+                 user_agent='*', timeout=10):
+        self.rate = rate
+        self.burst = burst
+        self.host_rates = host_rates or {}
+        self.respect_robots_txt = respect_robots_txt
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4)
+
+    def get_crawl_delay(self, url):
+        """Return the crawl delay (in seconds) in the robots.txt of the URL's host, if any."""
+        parsed_url = urlparse(url)
+        robots_url = f'{parsed_url.scheme}://{parsed_url.netloc}/robots.txt'
+        try:
+            response = requests.get(robots_url, timeout=self.timeout)
+            if response.status_code >= 400:
+                return None
+            robots = RobotFileParser(robots_url)
+            robots.parse(response.text.splitlines())
+            request_rate = robots.request_rate(self.user_agent)
+            if request_rate:
+                return request_rate.seconds / request_rate.requests
+            return robots.crawl_delay(self.user_agent)
+        except Exception as e:
+            logging.error(f'Failed to read robots.txt at {robots_url}. Details: {e}')
+            return None
+
+    def _create_bucket(self, url, domain):
+        rate = self.host_rates.get(domain, self.rate)
+        if self.respect_robots_txt:
+            crawl_delay = self.get_crawl_delay(url)
+            if crawl_delay:
+                logging.info(f'Using crawl delay of {crawl_delay} seconds from robots.txt for {domain}.')
+                rate = min(rate, 1 / crawl_delay) if rate else 1 / crawl_delay
+        return TokenBucket(rate, self.burst) if rate else None
+
+    def try_acquire(self, url):
+        """Take a token for a request to the URL's host if one is available and return 0, otherwise
+        return the seconds to wait before trying again."""
+        domain = extract_domain(url)
+        with self._lock:
+            if domain not in self._buckets:
+                if self.respect_robots_txt:
+                    # robots.txt is read in the background, so other hosts aren't held up
+                    self._buckets[domain] = self._executor.submit(self._create_bucket, url, domain)
+                else:
+                    self._buckets[domain] = self._create_bucket(url, domain)
+            bucket = self._buckets[domain]
+            if isinstance(bucket, Future):
+                if not bucket.done():
+                    return ROBOTS_POLL_INTERVAL
+                bucket = self._buckets[domain] = bucket.result()
+        return bucket.try_acquire() if bucket is not None else 0
+
+    def close(self):
+        """Shut down the threads that read robots.txt files."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RunMetrics:
+    """Collect the timings of each validated URL for the end-of-run summary."""
+
+    def __init__(self, slowest_count=10):
+        self.slowest_count = slowest_count
+        self.start_time = time.monotonic()
+        self.url_count = 0
+        self.bytes = 0
+        self.phase_totals = dict.fromkeys(TIMING_PHASES, 0.0)
+        self._latencies = defaultdict(lambda: array('d'))
+        self._slowest = []
+        self._lock = threading.Lock()
+
+    def record(self, url, timings, bytes_read):
+        """Add the timings (a dict of seconds per phase) and body bytes read of a validated URL."""
+        total = timings.get('total', 0.0)
+        with self._lock:
+            self.url_count += 1
+            self.bytes += bytes_read
+            for phase, seconds in timings.items():
+                self.phase_totals[phase] = self.phase_totals.get(phase, 0.0) + seconds
+            self._latencies[extract_domain(url)].append(total)
+            if len(self._slowest) < self.slowest_count:
+                heapq.heappush(self._slowest, (total, url))
+            else:
+                heapq.heappushpop(self._slowest, (total, url))
+
+    @staticmethod
+    def percentile(values, percent):
+        """Return the nearest-rank percentile of the sorted values."""
+        if not values:
+            return None
+        index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+        return values[index]
+
+    def summary(self):
+        """Return the run summary as a dict."""
+        with self._lock:
+            elapsed = time.monotonic() - self.start_time
+            hosts = {}
+            for host, latencies in self._latencies.items():
+                latencies = sorted(latencies)
+                hosts[host] = {'count': len(latencies),
+                               'p50': self.percentile(latencies, 50),
+                               'p95': self.percentile(latencies, 95),
+                               'p99': self.percentile(latencies, 99)}
+            return {
+                'urls': self.url_count,
+                'elapsed_seconds': elapsed,
+                'urls_per_second': self.url_count / elapsed if elapsed else 0.0,
+                'bytes': self.bytes,
+                'phase_seconds': dict(self.phase_totals),
+                'hosts': hosts,
+                'slowest': [{'url': url, 'seconds': seconds}
+                            for seconds, url in sorted(self._slowest, reverse=True)]
+            }
+
+    def to_prometheus(self):
+        """Return the run summary in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = ['# TYPE link_validation_urls_total counter',
+                 f'link_validation_urls_total {summary["urls"]}',
+                 '# TYPE link_validation_bytes_total counter',
+                 f'link_validation_bytes_total {summary["bytes"]}',
+                 '# TYPE link_validation_duration_seconds gauge',
+                 f'link_validation_duration_seconds {summary["elapsed_seconds"]}',
+                 '# TYPE link_validation_urls_per_second gauge',
+                 f'link_validation_urls_per_second {summary["urls_per_second"]}',
+                 '# TYPE link_validation_phase_seconds_total counter']
+        for phase, seconds in summary['phase_seconds'].items():
+            lines.append(f'link_validation_phase_seconds_total{{phase="{phase}"}} {seconds}')
+        lines.append('# TYPE link_validation_latency_seconds summary')
+        for host, stats in summary['hosts'].items():
+            for quantile in ('p50', 'p95', 'p99'):
+                lines.append(f'link_validation_latency_seconds{{host="{host}",'
+                             f'quantile="0.{quantile[1:]}"}} {stats[quantile]}')
+            lines.append(f'link_validation_latency_seconds_count{{host="{host}"}} {stats["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, metrics_file, metrics_format='json'):
+        """Write the run summary to the file as JSON or in the Prometheus text format."""
+        if metrics_format not in METRICS_FORMATS:
+            raise ValueError(f'Unsupported metrics format: {metrics_format}')
+        with open(metrics_file, 'w') as file:
+            if metrics_format == 'prometheus':
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), file, indent=2)
+        logging.info(f'Run metrics exported to: {metrics_file}')
+
+
+class ResultWriter:
+    """Buffered writer that keeps the results file open for the run and can be shared by
+    concurrent workers. on_flush is called after every flush."""
+
+    def __init__(self, data_file, data_format=None, columns=RESULT_COLUMNS,
+                 flush_rows=100, flush_interval=5, append=False, on_flush=None):
+        self.data_file = data_file
+        self.data_format = data_format or get_data_format(data_file)
+        if self.data_format not in DATA_FORMATS:
+            raise ValueError(f'Unsupported data format: {self.data_format}')
+        self.columns = columns
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self._rows = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        if append and self.data_format == 'csv.gz' and os.path.exists(data_file):
+            # an interrupted run leaves a cut-off gzip stream, which would hide the appended rows
+            recover_gzip(data_file)
+        write_header = not (append and os.path.exists(data_file) and os.path.getsize(data_file))
+        mode = 'at' if append else 'wt'
+        if self.data_format == 'csv.gz':
+            self._file = gzip.open(data_file, mode=mode, newline='')
+        else:
+            self._file = open(data_file, mode=mode, newline='')
+        if self.data_format == 'jsonl':
+            self._writer = None
+        else:
+            self._writer = csv.writer(self._file)
+            if write_header:
+                self._writer.writerow(list(columns.values()))
+
+    def writerow(self, row):
+        """Add a row (a dict keyed by column) to the buffer, flushing it if it is due."""
+        with self._lock:
+            self._rows.append(row)
+            if (len(self._rows) >= self.flush_rows or
+                    time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        """Write all buffered rows to the results file."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        for row in self._rows:
+            if self._writer is None:
+                self._file.write(json.dumps({column: row.get(column) for column in self.columns},
+                                            default=str) + '\n')
+            else:
+                self._writer.writerow([row.get(column) for column in self.columns])
+        self._rows = []
+        self._file.flush()
+        self._last_flush = time.monotonic()
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        """Flush the remaining rows and close the results file."""
+        with self._lock:
+            self._flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def recover_gzip(gzip_file, chunk_size=1048576):
+    """Rewrite the gzip file with only its complete lines, dropping the end of a cut-off stream."""
+    temp_file = f'{gzip_file}.tmp'
+    decompressor = zlib.decompressobj(wbits=31)
+    tail = b''
+    with open(gzip_file, 'rb') as source, gzip.open(temp_file, 'wb') as target:
+        chunk = source.read(chunk_size)
+        while chunk:
+            try:
+                data = tail + decompressor.decompress(chunk)
+            except zlib.error as e:
+                logging.error(f'Dropped the unreadable end of {gzip_file}. Details: {e}')
+                break
+            lines_end = data.rfind(b'\n') + 1
+            target.write(data[:lines_end])
+            tail = data[lines_end:]
+            chunk = b''
+            if decompressor.eof:
+                # files appended to by a resumed run have several gzip members
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+            chunk = chunk or source.read(chunk_size)
+        else:
+            data = tail + decompressor.flush()
+            target.write(data[:data.rfind(b'\n') + 1])
+    os.replace(temp_file, gzip_file)
+
+
+class CrawlCheckpoint:
+    """Append-only journal of the queued and completed URLs of a run, so it can be resumed.
+    Records are only written when the ResultWriter flushes, after the rows they refer to."""
+
+    def __init__(self, checkpoint_file, resume=False):
+        self.checkpoint_file = checkpoint_file
+        self.frontier = []
+        self.sitemap_parsed = False
+        self.completed = {}
+        self.links = []
+        if resume:
+            self._load()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._file = open(checkpoint_file, mode='a' if resume else 'w')
+
+    def _load(self):
+        if not os.path.exists(self.checkpoint_file):
+            logging.info(f'No checkpoint found at {self.checkpoint_file}, starting from scratch.')
+            return
+        with open(self.checkpoint_file) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last record may be incomplete if the run was interrupted while writing it
+                    continue
+                if 'queued' in record:
+                    self.frontier.append(record['queued'])
+                elif 'completed' in record:
+                    self.completed.setdefault(record['depth'], set()).add(record['completed'])
+                    if record.get('links'):
+                        self.links.append((record['depth'], record['completed'], record['links']))
+                elif 'sitemap_parsed' in record:
+                    self.sitemap_parsed = True
+        logging.info(f'Loaded checkpoint from {self.checkpoint_file}: {len(self.frontier)} queued '
+                     f'and {sum(len(urls) for urls in self.completed.values())} completed URLs.')
+
+    def _write(self, record):
+        with self._lock:
+            self._pending.append(json.dumps(record))
+
+    def is_completed(self, url, depth):
+        """Return True if the URL has already been validated at the given depth."""
+        return url in self.completed.get(depth, ())
+
+    def queue(self, url):
+        """Record a sitemap URL that has been queued for validation."""
+        self.frontier.append(url)
+        self._write({'queued': url})
+
+    def mark_sitemap_parsed(self):
+        """Record that all URLs have been read from the sitemap."""
+        self.sitemap_parsed = True
+        self._write({'sitemap_parsed': True})
+
+    def complete(self, url, depth, links=None):
+        """Record that the URL has been validated, along with the links found on it. Call this
+        before writing its row, so the record is synced with the same flush as the row."""
+        self.completed.setdefault(depth, set()).add(url)
+        record = {'completed': url, 'depth': depth}
+        if links:
+            record['links'] = links
+        self._write(record)
+
+    def flush(self):
+        """Write the pending records and sync the journal to disk."""
+        with self._lock:
+            for record in self._pending:
+                self._file.write(record + '\n')
+            self._pending = []
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """Sync and close the journal."""
+        self.flush()
+        self._file.close()
+
+
+class LinkGraph:
+    """Compact store of the links found on pages, aggregated by the URL they point to. The
+    links are moved to a temporary SQLite database past spill_threshold links."""
+
+    def __init__(self, spill_threshold=1000000):
+        self.spill_threshold = spill_threshold
+        self._ids = {}
+        self._strings = []
+        self._edges = {}
+        self._seen = set()
+        self._db = None
+        self._db_file = None
+        self._db_pending = []
+
+    def _intern(self, string):
+        string_id = self._ids.get(string)
+        if string_id is None:
+            string_id = self._ids[string] = len(self._strings)
+            self._strings.append(string)
+        return string_id
+
+    def add(self, url, link_text, source_url):
+        """Add a link to the URL with the given link text, found on the source URL."""
+        target, text, source = self._intern(url), self._intern(link_text), self._intern(source_url)
+        if self._db is not None:
+            self._db_pending.append((target, text, source))
+            if len(self._db_pending) >= 10000:
+                self._flush_db()
+            return
+        key = (target << 64) | (text << 32) | source
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        if target not in self._edges:
+            self._edges[target] = array('q')
+        self._edges[target].extend((text, source))
+        if len(self._seen) > self.spill_threshold:
+            self._spill()
+
+    def add_links(self, source_url, links):
+        """Add the (url, link text) pairs found on the source URL."""
+        for url, link_text in links:
+            self.add(url, link_text, source_url)
+
+    def _spill(self):
+        logging.info(f'Link graph has more than {self.spill_threshold} links, moving them to SQLite.')
+        fd, self._db_file = tempfile.mkstemp(prefix='link_graph_', suffix='.sqlite')
+        os.close(fd)
+        self._db = sqlite3.connect(self._db_file)
+        self._db.execute('CREATE TABLE edges (target INTEGER, text INTEGER, source INTEGER, '
+                         'PRIMARY KEY (target, text, source)) WITHOUT ROWID')
+        for target, edges in self._edges.items():
+            self._db.executemany('INSERT OR IGNORE INTO edges VALUES (?, ?, ?)',
+                                 ((target, edges[i], edges[i + 1]) for i in range(0, len(edges), 2)))
+        self._db.commit()
+        self._edges = {}
+        self._seen = set()
+
+    def _flush_db(self):
+        self._db.executemany('INSERT OR IGNORE INTO edges VALUES (?, ?, ?)', self._db_pending)
+        self._db.commit()
+        self._db_pending = []
+
+    def targets(self, exclude=()):
+        """Yield each URL that has links pointing to it, skipping the URLs in exclude."""
+        if self._db is not None:
+            self._flush_db()
+            target_ids = (row[0] for row in self._db.execute('SELECT DISTINCT target FROM edges'))
+        else:
+            target_ids = iter(self._edges)
+        for target in target_ids:
+            url = self._strings[target]
+            if url not in exclude:
+                yield url
+
+    def incoming(self, url):
+        """Return the link texts and source URLs of the links to the URL as two lists."""
+        target = self._ids.get(url)
+        if self._db is not None:
+            self._flush_db()
+            edges = [value for row in self._db.execute('SELECT text, source FROM edges '
+                                                       'WHERE target = ?', (target,))
+                     for value in row]
+        else:
+            edges = self._edges.get(target, ())
+        return ([self._strings[text] for text in edges[0::2]],
+                [self._strings[source] for source in edges[1::2]])
+
+    def close(self):
+        """Remove the temporary SQLite database, if the links were moved to one."""
+        if self._db is not None:
+            self._db.close()
+            os.remove(self._db_file)
+            self._db = None
+
+
+def record_timings(data, metrics, timing_columns=False):
+    """Move the timings out of the validation data into the run metrics, adding them to the
+    data as timing columns if timing_columns is True."""
+    timings = data.pop('timings', {})
+    metrics.record(data['url'], timings, timings.pop('bytes_read', 0))
+    if timing_columns:
+        data.update({f'{phase}_time': round(timings.get(phase, 0.0), 6) for phase in TIMING_PHASES})
+    return data
+
+
+def record_redirects(data, redirect_columns=False, report_writer=None):
+    """Move the redirect hops out of the data, adding the redirect columns if redirect_columns
+    is True and the link to the redirect report if a writer is given."""
+    hops = data.pop('redirects', [])
+    redirect_data = {
+        'redirect_count': len(hops),
+        'final_url': hops[-1][2] if hops else data['url']
+    }
+    if redirect_columns:
+        data.update(redirect_data)
+    if report_writer and hops:
+        report_writer.writerow({**data, **redirect_data,
+                                'redirect_codes': ' '.join(str(hop[0]) for hop in hops)})
+    return data
+
+
+def get_data_format(data_file):
+    """Determine the output format from the extension of the data file."""
+    if data_file.endswith('.csv.gz'):
+        return 'csv.gz'
+    if data_file.endswith('.jsonl'):
+        return 'jsonl'
+    return 'csv'
+
+
+def write_data(writer, url, response_code, exception, details, response_length,
+               page_title, url_first_party, link_text, source_url, **extra_columns):
+    """Write the results (and any extra columns, such as timings) to the results file
+    through the given ResultWriter."""
+    writer.writerow({'url': url, 'response_code': response_code, 'exception': exception,
+                     'details': details, 'response_length': response_length,
+                     'page_title': page_title, 'url_first_party': url_first_party,
+                     'link_text': link_text, 'source_url': source_url, **extra_columns})
+
+
+class ValidationCache:
+    """Persistent SQLite cache of validation results and their ETag/Last-Modified headers,
+    keyed by URL. Entries recorded under another namespace are ignored. Sites sharing the
+    cache file should share one ValidationCache, see with_namespace()."""
+
+    def __init__(self, cache_file, ttl=86400, namespace='', commit_every=100, busy_timeout=30):
+        self.ttl = ttl
+        self.namespace = namespace
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+        # other processes using the cache file are waited for up to busy_timeout seconds
+        self._conn = sqlite3.connect(cache_file, timeout=busy_timeout, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS results (url TEXT PRIMARY KEY, '
+                           'namespace TEXT, data TEXT, etag TEXT, last_modified TEXT, '
+                           'fetched_at REAL)')
+        self._conn.commit()
+
+    def with_namespace(self, namespace, ttl=None):
+        """Return a view of the cache with its own namespace and TTL that shares this cache's
+        database connection. Closing the view closes the shared connection."""
+        view = copy.copy(self)
+        view.namespace = namespace
+        view.ttl = self.ttl if ttl is None else ttl
+        return view
+
+    def get(self, url):
+        """Return the cached entry for the URL as a dict, or None if there is no usable entry."""
+        with self._lock:
+            row = self._conn.execute('SELECT data, etag, last_modified, fetched_at FROM results '
+                                     'WHERE url = ? AND namespace = ?',
+                                     (url, self.namespace)).fetchone()
+        if row is None:
+            return None
+        data, etag, last_modified, fetched_at = row
+        return {'data': json.loads(data), 'etag': etag, 'last_modified': last_modified,
+                'fetched_at': fetched_at}
+
+    def is_fresh(self, entry):
+        """Return True if the entry is younger than the cache TTL."""
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, url, data, headers=None):
+        """Store the validation result and the validator headers of the response for the URL."""
+        headers = headers or {}
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                               (url, self.namespace, json.dumps(data), headers.get('ETag'),
+                                headers.get('Last-Modified'), time.time()))
+            self._commit_if_due()
+
+    def touch(self, url):
+        """Mark the cached entry for the URL as revalidated now."""
+        with self._lock:
+            self._conn.execute('UPDATE results SET fetched_at = ? WHERE url = ?',
+                               (time.time(), url))
+            self._commit_if_due()
+
+    def _commit_if_due(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        """Commit pending changes and close the cache database."""
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def conditional_headers(entry):
+    """Build the If-None-Match/If-Modified-Since request headers for the cached entry."""
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+class RedirectCache:
+    """Run-wide cache of permanent (301/308) redirects, so later requests go straight to the target."""
+
+    def __init__(self, max_hops=10):
+        self.max_hops = max_hops
+        self.hops_skipped = 0
+        self._redirects = {}
+        self._lock = threading.Lock()
+
+    def add(self, hops):
+        """Cache the permanent redirects among the (status code, URL, target) hops."""
+        with self._lock:
+            for status_code, url, target in hops:
+                if status_code in PERMANENT_REDIRECT_CODES and url != target:
+                    self._redirects[url] = (status_code, target)
+
+    def resolve(self, url):
+        """Follow the cached redirects from the URL and return the resolved URL and the
+        (status code, URL, target) hops that were followed."""
+        hops = []
+        with self._lock:
+            while url in self._redirects and len(hops) < self.max_hops:
+                status_code, target = self._redirects[url]
+                if any(hop[1] == target for hop in hops):
+                    break
+                hops.append((status_code, url, target))
+                url = target
+            self.hops_skipped += len(hops)
+        return url, hops
+
+
+def get_redirect_hops(response):
+    """Return the redirects followed to get the response as (status code, URL, target) hops,
+    including the hops the session skipped using its RedirectCache."""
+    if response is None or not response.history:
+        return []
+    hops = []
+    targets = [redirect.url for redirect in response.history[1:]] + [response.url]
+    for redirect, target in zip(response.history, targets):
+        skipped = getattr(redirect, 'skipped_redirects', [])
+        hops.append((redirect.status_code, redirect.url, skipped[0][1] if skipped else target))
+        hops.extend(skipped)
+    return hops
+
+
+class ResultMemo:
+    """Run-wide memo of third-party validation results, shared by the sites of a batch run.
+    At most max_size results are kept, dropping the least recently used ones."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self._results = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, validate):
+        """Return a copy of the result for the key, calling validate() to compute it if needed.
+        If another site is already validating the key, wait for its result instead."""
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+                # no time was spent validating the URL again
+                return {**result, 'timings': {}}
+            event = self._pending.get(key)
+            computing = event is None
+            if computing:
+                event = self._pending[key] = threading.Event()
+        if not computing:
+            event.wait()
+            # if the validation failed, this validates the URL itself
+            return self.get(key, validate)
+        data = None
+        try:
+            data = validate()
+            return data
+        finally:
+            with self._lock:
+                del self._pending[key]
+                if data is not None:
+                    # a copy, as the caller moves the timings and redirects out of the data
+                    self._results[key] = dict(data)
+                    if len(self._results) > self.max_size:
+                        self._results.popitem(last=False)
+            event.set()
 
 
 def load_config(config_file):
@@ -27,10 +941,13 @@ def load_config(config_file):
         return json.load(f)
 
 
-def get_url(url, timeout=10):
-    """Send a GET request to the URL with the specified timeout."""
+def get_url(url, timeout=10, session=None, **kwargs):
+    """Send a GET request to the URL with the specified timeout, using the session if given.
+    Additional keyword arguments (such as headers) are passed on to the request."""
+    start = time.perf_counter()
     try:
-        response = requests.get(url, timeout=timeout)
+        response = (session or requests).get(url, timeout=timeout, **kwargs)
+        record_response_timing(response, start)
         response.raise_for_status()
         return response, None, None
     except requests.exceptions.Timeout as e:
@@ -46,20 +963,200 @@ def get_url(url, timeout=10):
         return e.response, 'RequestException', str(e)
 
 
-def parse_sitemap(sitemap_content):
-    """Parse the sitemap XML content and return a list of URLs."""
+def iter_pending_sitemap_urls(checkpoint, sitemap_url, timeout=10, session=None):
+    """Yield the sitemap URLs that still need to be validated, recording them in the checkpoint."""
+    queued = set(checkpoint.frontier)
+    for url in list(checkpoint.frontier):
+        if not checkpoint.is_completed(url, 0):
+            yield url
+    if checkpoint.sitemap_parsed:
+        return
+    errors = []
+    for url in iter_sitemap_urls(sitemap_url, timeout, session, errors=errors):
+        if url in queued:
+            continue
+        checkpoint.queue(url)
+        yield url
+    # only a complete read of the sitemap is final; otherwise --resume reads it again
+    if errors:
+        logging.info(f'Could not read all of the sitemap, so it will be read again on --resume. '
+                        f'Failed sitemaps: {errors}')
+    else:
+        checkpoint.mark_sitemap_parsed()
+
+
+def probe_url(url, timeout=10, session=None, max_bytes=65536, **kwargs):
+    """Check the URL with a HEAD request, or with a GET request that stops after the page title
+    if HEAD is rejected. Returns the response, exception, details, response length and title."""
+    try:
+        response = (session or requests).head(url, timeout=timeout, allow_redirects=True, **kwargs)
+        if response.status_code < 400:
+            return response, None, None, get_content_length(response), None
+    except requests.exceptions.RequestException as e:
+        logging.info(f'HEAD request to {url} failed, falling back to GET. Details: {e}')
+
+    response, exception, details = get_url(url, timeout, session, stream=True, **kwargs)
+    if response is None:
+        return response, exception, details, 0, None
+    head = bytearray()
+    with response, timed('download'):
+        for chunk in response.iter_content(chunk_size=8192):
+            head += chunk
+            record_bytes_read(len(chunk))
+            if len(head) >= max_bytes or TITLE_PATTERN.search(head):
+                break
+    title_match = TITLE_PATTERN.search(head)
+    title = None
+    if title_match:
+        title = html.unescape(title_match.group(1).decode(response.encoding or 'utf-8', errors='replace'))
+    return response, exception, details, get_content_length(response, len(head)), title
+
+
+def is_parseable_content(content_type):
+    """Return True if the Content-Type is HTML, XML or text (or missing), so the page can be
+    parsed. Binary content (PDFs, images, videos, downloads) is not parsed."""
+    if not content_type:
+        return True
+    media_type = content_type.split(';')[0].strip().lower()
+    return media_type.startswith('text/') or media_type.endswith(('/xml', '+xml'))
+
+
+def get_charset(content_type):
+    """Return the charset given in the Content-Type, or None to let the parser detect it."""
+    match = CHARSET_PATTERN.search(content_type or '')
+    return match.group(1) if match else None
+
+
+def get_content_length(response, default=0):
+    """Return the Content-Length of the response, or default if it is missing or invalid."""
+    # a repeated header is joined with commas, which is only valid if the values are the same
+    values = {value.strip() for value in response.headers.get('Content-Length', '').split(',')}
+    value = values.pop() if len(values) == 1 else ''
+    return int(value) if value.isdecimal() else default
+
+
+def read_body(response, max_bytes=10485760):
+    """Read up to max_bytes of the response body and return it with whether it was truncated.
+    The body is None if the content type isn't parseable."""
+    if not is_parseable_content(response.headers.get('Content-Type')):
+        return None, False
+    chunks = []
+    length = 0
+    with timed('download'):
+        for chunk in response.iter_content(chunk_size=65536):
+            chunks.append(chunk)
+            length += len(chunk)
+            record_bytes_read(len(chunk))
+            if length > max_bytes:
+                chunks[-1] = chunk[:len(chunk) - (length - max_bytes)]
+                return b''.join(chunks), True
+    return b''.join(chunks), False
+
+
+class SpooledDownload(io.RawIOBase):
+    """Readable file that downloads the response body in a background thread into a spooled
+    temporary file, so the download doesn't wait for the reader. Reads wait for the data."""
+
+    def __init__(self, response, chunk_size=65536, max_memory=1048576):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._written = 0
+        self._position = 0
+        self._done = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._download, args=(response, chunk_size),
+                                        daemon=True)
+        self._thread.start()
+
+    def _download(self, response, chunk_size):
+        """Write the response body to the temporary file until it's fully read or closed."""
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size):
+                    with self._condition:
+                        if self.closed:
+                            return
+                        self._file.seek(self._written)
+                        self._file.write(chunk)
+                        self._written += len(chunk)
+                        self._condition.notify_all()
+        except Exception as e:
+            self._error = e
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self._condition:
+            while self._position == self._written and not self._done:
+                self._condition.wait()
+            if self._position == self._written:
+                if self._error is not None:
+                    raise self._error
+                return 0
+            self._file.seek(self._position)
+            data = self._file.read(min(len(buffer), self._written - self._position))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        with self._condition:
+            if not self.closed:
+                self._file.close()
+                super().close()
+
+
+def iter_sitemap_urls(sitemap_url, timeout=10, session=None, visited=None, errors=None):
+    """Stream the sitemap (following sitemap indexes) at the URL and yield its page URLs.
+    The sitemap is downloaded with a SpooledDownload, so a slow consumer doesn't make the server
+    time out. The URLs of sitemaps that couldn't be fetched or parsed are added to errors, if given."""
+    visited = set() if visited is None else visited
+    if sitemap_url in visited:
+        return
+    visited.add(sitemap_url)
+
+    logging.info(f'Parsing sitemap content from {sitemap_url}...')
+    response, exception, details = get_url(sitemap_url, timeout, session, stream=True)
+    if response is None or exception:
+        logging.error(f'Failed to fetch the sitemap at {sitemap_url}. Details: {details}')
+        if errors is not None:
+            errors.append(sitemap_url)
+        return
+
+    url_count = 0
+    child_sitemaps = []
     try:
-        logging.info('Parsing sitemap content...')
-        sitemap_content = sitemap_content.text
-        soup = BeautifulSoup(sitemap_content, 'xml')
-        urls = [loc.text for loc in soup.find_all('loc')]
-        logging.info(f'Parsed sitemap content. Found {len(urls)} URLs.')
-        if not urls:
-            logging.info('No URLs found in the sitemap content.')
-        return urls
+        with SpooledDownload(response) as download:
+            stream = io.BufferedReader(download)
+            if stream.peek(2)[:2] == b'\x1f\x8b':
+                stream = gzip.GzipFile(fileobj=stream)
+            for _, element in etree.iterparse(stream, events=('end',), tag=('{*}url', '{*}sitemap')):
+                loc = (element.findtext('{*}loc') or '').strip()
+                if loc and etree.QName(element).localname == 'sitemap':
+                    child_sitemaps.append(loc)
+                elif loc:
+                    url_count += 1
+                    yield loc
+                # free the parsed elements so memory stays flat on large sitemaps
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
     except Exception as e:
-        logging.error(f'Failed to parse the sitemap XML. Details: {e}')
-        return []
+        logging.error(f'Failed to parse the sitemap XML at {sitemap_url}. Details: {e}')
+        if errors is not None:
+            errors.append(sitemap_url)
+
+    logging.info(f'Parsed sitemap content from {sitemap_url}. Found {url_count} URLs '
+                 f'and {len(child_sitemaps)} child sitemaps.')
+    if not url_count and not child_sitemaps:
+        logging.info('No URLs found in the sitemap content.')
+    for child_sitemap in child_sitemaps:
+        yield from iter_sitemap_urls(child_sitemap, timeout, session, visited, errors)
 
 
 def extract_domain(url):
@@ -72,6 +1169,21 @@ def extract_domain(url):
         return url
 
 
+def normalize_url(url):
+    """Normalize the URL for deduplication: lowercase the scheme and domain, remove the default
+    port and the fragment, and use '/' for an empty path."""
+    try:
+        parsed_url = urlparse(url)
+        scheme, netloc = parsed_url.scheme.lower(), parsed_url.netloc.lower()
+        if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+            netloc = netloc.rsplit(':', 1)[0]
+        return urlunparse((scheme, netloc, parsed_url.path or '/', parsed_url.params,
+                           parsed_url.query, ''))
+    except Exception as e:
+        logging.error(f'Failed to normalize the URL. Details: {e}')
+        return url
+
+
 def is_url_first_party(url, first_party_domains):
     """Determine if the URL is first-party (True) or third-party (False)
     based on first_party_domains list."""
@@ -83,13 +1195,44 @@ def is_url_first_party(url, first_party_domains):
         return None
 
 
+class PatternMatcher:
+    """Match text against regex patterns that are compiled once and combined into one pattern."""
+
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(patterns)
+        self.flags = flags
+        self._compiled = [re.compile(pattern, flags) for pattern in self.patterns]
+        self._combined = None
+        # combining renumbers the groups, which changes the meaning of backreferences
+        if self.patterns and not any(BACKREFERENCE_PATTERN.search(pattern) for pattern in self.patterns):
+            try:
+                self._combined = re.compile('|'.join(f'(?:{pattern})' for pattern in self.patterns), flags)
+            except re.error:
+                # patterns with global flags or duplicate group names cannot be combined
+                pass
+
+    def search(self, text):
+        """Return True if the text matches any of the patterns."""
+        if self._combined is not None:
+            return self._combined.search(text) is not None
+        return any(pattern.search(text) for pattern in self._compiled)
+
+    def matches(self, text):
+        """Return the list of patterns that match the text."""
+        if not self.search(text):
+            return []
+        return [pattern for pattern, compiled in zip(self.patterns, self._compiled)
+                if compiled.search(text)]
+
+
 def is_url_excluded(url, urls_to_exclude):
-    """Check if the URL is in the exclusion list."""
+    """Check if the URL is in the exclusion list (a list of patterns or a PatternMatcher)."""
     try:
-        exclude_patterns = [re.compile(pattern) for pattern in urls_to_exclude]
-        matched_url = [pattern.search(url) for pattern in exclude_patterns if pattern.search(url)]
-        if matched_url:
-            logging.info(f'Skipping {url} as it matches pattern(s) {matched_url} in the excluded list.')
+        if not isinstance(urls_to_exclude, PatternMatcher):
+            urls_to_exclude = PatternMatcher(urls_to_exclude)
+        matched_patterns = urls_to_exclude.matches(url)
+        if matched_patterns:
+            logging.info(f'Skipping {url} as it matches pattern(s) {matched_patterns} in the excluded list.')
             return True
         return False
     except Exception as e:
@@ -97,12 +1240,13 @@ def is_url_excluded(url, urls_to_exclude):
         return None
 
 
-def contains_excluded_phrases(content, phrases_to_exclude):
-    """Check if the content contains any of the excluded phrases."""
+def contains_excluded_phrases(text, phrases_to_exclude):
+    """Check if the page text contains any of the excluded phrases (a list of phrases or a
+    case-insensitive PatternMatcher)."""
     try:
-        content = content.body
-        matched_phrases = [phrase for phrase in phrases_to_exclude
-                           if re.search(phrase, content.get_text(), re.IGNORECASE)]
+        if not isinstance(phrases_to_exclude, PatternMatcher):
+            phrases_to_exclude = PatternMatcher(phrases_to_exclude, re.IGNORECASE)
+        matched_phrases = phrases_to_exclude.matches(text)
 
         if matched_phrases:
             logging.info(f'Excluded phrase(s) "{matched_phrases}" found in page.')
@@ -136,9 +1280,122 @@ def extract_urls_from_content(content):
         return []
 
 
+def parse_page_lxml(body, extract_links=True, encoding=None):
+    """Extract the title, body text and links from the HTML content using lxml."""
+    page = {'title': None, 'text': None, 'links': []}
+    try:
+        html_parser = lxml.html.HTMLParser(encoding=encoding) if encoding else None
+        root = lxml.html.document_fromstring(body, parser=html_parser)
+    except (etree.ParserError, ValueError, LookupError) as e:
+        logging.error(f'Failed to parse page content. Details: {e}')
+        return page
+
+    title_tag = root.find('.//title')
+    page['title'] = title_tag.text_content() if title_tag is not None else None
+    body_tag = root.find('body')
+    if body_tag is not None:
+        if extract_links:
+            links = {(a_tag.get('href'), ''.join(text.strip() for text in a_tag.itertext()))
+                     for a_tag in body_tag.iter('a')
+                     if a_tag.get('href', '').startswith('http')}
+            page['links'] = list(links)
+        # match BeautifulSoup's get_text(), which leaves out script and style contents
+        etree.strip_elements(body_tag, 'script', 'style', 'template', with_tail=False)
+        page['text'] = body_tag.text_content()
+    return page
+
+
+def parse_page_bs4(body, extract_links=True, encoding=None):
+    """Extract the title, body text and links from the HTML content using BeautifulSoup."""
+    if isinstance(body, bytes):
+        content = BeautifulSoup(body, 'html.parser', from_encoding=encoding)
+    else:
+        content = BeautifulSoup(body, 'html.parser')
+    return {
+        'title': extract_page_title(content),
+        'text': content.body.get_text() if content.body else None,
+        'links': extract_urls_from_content(content) if extract_links else []
+    }
+
+
+def parse_page(body, parser='lxml', extract_links=True, encoding=None):
+    """Parse the HTML content (text, or bytes in the given encoding, which is detected by the
+    parser if None) with the given parser backend and return its title, text and links."""
+    if parser == 'lxml':
+        return parse_page_lxml(body, extract_links, encoding)
+    elif parser == 'html.parser':
+        return parse_page_bs4(body, extract_links, encoding)
+    raise ValueError(f'Unsupported HTML parser: {parser}')
+
+
+def analyze_page(body, parser='lxml', extract_links=True, encoding=None, phrases_to_exclude=()):
+    """Parse the page and check its text for excluded phrases. Returns the title, links,
+    excluded phrases and timings."""
+    start = time.perf_counter()
+    page = parse_page(body, parser, extract_links, encoding)
+    parsed = time.perf_counter()
+    excluded_match = contains_excluded_phrases(page['text'], phrases_to_exclude)
+    return {
+        'title': page['title'],
+        'links': page['links'],
+        'excluded_match': excluded_match,
+        'timings': {'parse': parsed - start, 'exclusion': time.perf_counter() - parsed}
+    }
+
+
+def get_matcher_key(matcher):
+    """Return a key that identifies the PatternMatcher by its patterns and flags."""
+    return (tuple(matcher.patterns), matcher.flags)
+
+
+def init_parse_worker(phrase_matchers):
+    """Install the phrase matchers in a ParsePool worker process, so they are compiled once."""
+    _worker_phrase_matchers.update((get_matcher_key(matcher), matcher) for matcher in phrase_matchers)
+
+
+def analyze_page_in_worker(body, parser, extract_links, encoding, phrases_key):
+    """Run analyze_page with one of the phrase matchers installed in the worker process."""
+    return analyze_page(body, parser, extract_links, encoding, _worker_phrase_matchers[phrases_key])
+
+
+class ParsePool:
+    """Process pool that runs analyze_page, with at most max_pending pages queued at once.
+    The phrase_matchers of the sites are sent to each worker once, when it starts."""
+
+    def __init__(self, max_workers, max_pending=None, phrase_matchers=()):
+        # workers are started lazily from a threaded process, so they aren't forked
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._executor = ProcessPoolExecutor(max_workers=max_workers,
+                                             mp_context=multiprocessing.get_context(start_method),
+                                             initializer=init_parse_worker,
+                                             initargs=(list(phrase_matchers),))
+        self._phrase_keys = {get_matcher_key(matcher) for matcher in phrase_matchers}
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+
+    def analyze(self, body, parser='lxml', extract_links=True, encoding=None, phrases_to_exclude=()):
+        """Run analyze_page in a worker process and return its result."""
+        phrases_key = (get_matcher_key(phrases_to_exclude)
+                       if isinstance(phrases_to_exclude, PatternMatcher) else None)
+        with self._slots:
+            if phrases_key in self._phrase_keys:
+                future = self._executor.submit(analyze_page_in_worker, body, parser, extract_links,
+                                               encoding, phrases_key)
+            else:
+                future = self._executor.submit(analyze_page, body, parser, extract_links, encoding,
+                                               phrases_to_exclude)
+            return future.result()
+
+    def close(self):
+        """Shut down the worker processes."""
+        self._executor.shutdown()
+
+
+@collect_timings
 def validate_url(url, urls_to_exclude, phrases_to_exclude, first_party_domains,
-                 timeout, extract_urls):
-    """Validate the URL by checking its status, title, and content for exclusions."""
+                 timeout, extract_urls, session=None, parser='lxml', cache=None, probe_modes=None,
+                 redirects=None, max_body_bytes=10485760, parse_pool=None, probe=False):
+    """Validate the URL by checking its status, title, and content for exclusions. If probe is
+    True and the probe mode for the URL is 'head', only its status and length are checked."""
     logging.info(f'Validating URL at {url}')
     data = {
         'url': url,
@@ -148,107 +1405,495 @@ def validate_url(url, urls_to_exclude, phrases_to_exclude, first_party_domains,
         'response_length': 0,
         'page_title': None,
         'url_first_party': None,
-        'additional_urls': []
+        'additional_urls': [],
+        'redirects': []
     }
 
     # determine if the URL is first-party or third-party
     data['url_first_party'] = is_url_first_party(url, first_party_domains)
 
     # if url is excluded, log and return early
-    if is_url_excluded(url, urls_to_exclude):
+    with timed('exclusion'):
+        url_excluded = is_url_excluded(url, urls_to_exclude)
+    if url_excluded:
         data['exception'] = 'Excluded URL'
         data['details'] = 'Skipped URL as it matched pattern(s) in the excluded URL list.'
         return data
 
+    # reuse cached results: third-party results within the TTL are used without a request,
+    # everything else is revalidated with a conditional request
+    cached = cache.get(url) if cache else None
+    if cached and extract_urls and cached['data']['additional_urls'] is None:
+        cached = None
+    # probed results weren't checked for excluded phrases
+    if cached and not probe and cached['data'].get('probed'):
+        cached = None
+    if cached and not data['url_first_party'] and cache.is_fresh(cached):
+        return use_cached_data(data, cached, extract_urls)
+
+    # skip the permanent redirects seen earlier in the run
+    request_url, data['redirects'] = redirects.resolve(url) if redirects else (url, [])
+
+    probe_mode = (probe_modes or {}).get('first_party' if data['url_first_party'] else 'third_party')
+    if probe and probe_mode == 'head' and not extract_urls:
+        response, data['exception'], data['details'], response_length, page_title = probe_url(
+            request_url, timeout, session, headers=conditional_headers(cached))
+        add_redirects(data, response, redirects)
+        if cached and response is not None and response.status_code == 304:
+            cache.touch(url)
+            return use_cached_data(data, cached, extract_urls)
+        if response is not None:
+            data['response_code'] = response.status_code
+            data['response_length'] = response_length
+            data['page_title'] = page_title
+            if cache and response.status_code < 400:
+                cache.put(url, {**data, 'additional_urls': None, 'probed': True}, response.headers)
+        return data
+
     # get url and update log data
-    response, exception, details = get_url(url, timeout)
+    response, exception, details = get_url(request_url, timeout, session, stream=True,
+                                           headers=conditional_headers(cached))
     data['exception'] = exception
     data['details'] = details
+    add_redirects(data, response, redirects)
+    if response is None:
+        return data
 
-    # add response details to output
-    if response is not None and response.text:
-        response_content = BeautifulSoup(response.text, 'html.parser')
+    if cached and response.status_code == 304:
+        response.close()
+        cache.touch(url)
+        return use_cached_data(data, cached, extract_urls)
+
+    data['response_code'] = response.status_code
+    with response:
+        try:
+            body, truncated = read_body(response, max_body_bytes)
+        except requests.exceptions.RequestException as e:
+            logging.error(f'Failed to read page content from {url}. Details: {e}')
+            data['exception'] = 'RequestException'
+            data['details'] = str(e)
+            return data
+    content_type = response.headers.get('Content-Type')
+    if body is None:
+        # binary content isn't downloaded, so its length is taken from the headers
+        logging.info(f'Skipped parsing {url} as its content type is {content_type}')
+        data['response_length'] = get_content_length(response)
+    if truncated:
+        logging.info(f'Only read the first {max_body_bytes} bytes of {url}')
 
-        data['response_code'] = response.status_code
-        data['response_length'] = len(response.text) if response.text else 0
-        data['page_title'] = extract_page_title(response_content)
+    # add response details to output
+    if body:
+        # parse the page and check its content for excluded phrases
+        encoding = get_charset(content_type)
+        page = None
+        if parse_pool:
+            try:
+                page = parse_pool.analyze(body, parser, extract_urls, encoding, phrases_to_exclude)
+            except Exception as e:
+                # e.g. a BrokenProcessPool after a worker crashed: parse the page here instead
+                logging.error(f'Failed to analyze {url} in the parse pool, analyzing it in this '
+                              f'thread instead. Details: {e}')
+        if page is None:
+            page = analyze_page(body, parser, extract_urls, encoding, phrases_to_exclude)
+        for phase, seconds in page['timings'].items():
+            record_timing(phase, seconds)
 
-        # check response content for excluded phrases
-        excluded_match = contains_excluded_phrases(response_content, phrases_to_exclude)
+        data['response_length'] = len(body)
+        data['page_title'] = page['title']
+        excluded_match = page['excluded_match']
         if excluded_match:
             data['exception'] = 'Excluded Phrase'
             data['details'] = f'Response content contains excluded phrase(s): "{excluded_match}".'
 
         # extract additional URLs from response content
         if extract_urls:
-            data['additional_urls'] = extract_urls_from_content(response_content)
+            data['additional_urls'] = page['links']
+
+    if cache and response.status_code < 400:
+        cache.put(url, {**data, 'additional_urls': data['additional_urls'] if extract_urls else None},
+                  response.headers)
 
     return data
 
 
-def main():
-    """Main entry point for the script."""
-    parser = argparse.ArgumentParser(description="Validate URLs from a sitemap.")
-    parser.add_argument('--config', default='config.json', help='Path to the configuration file.')
-    parser.add_argument('--sitemap_url', help="URL of the sitemap to validate.")
-    args = parser.parse_args()
-    config = load_config(args.config)
+def add_redirects(data, response, redirects=None):
+    """Add the redirects followed to get the response to the validation data, caching the
+    permanent ones in the RedirectCache if given."""
+    hops = get_redirect_hops(response)
+    if redirects:
+        redirects.add(hops)
+    data['redirects'] = data['redirects'] + hops
 
-    sitemap_url = args.sitemap_url or config.get('sitemap_url')
-    if not sitemap_url:
-        logging.error("Error: 'sitemap_url' is required but not provided, either \
-                      in the configuration file or via the command line.")
-        sys.exit(1)
 
-    urls_to_exclude = config.get('urls_to_exclude', [])
-    phrases_to_exclude = config.get('phrases_to_exclude', [])
+def use_cached_data(data, cached, extract_urls):
+    """Fill in the validation data from the cached entry."""
+    logging.info(f'Using cached results for {data["url"]}')
+    cached_data = cached['data']
+    for key in ('response_code', 'exception', 'details', 'response_length', 'page_title'):
+        data[key] = cached_data[key]
+    if not data['redirects']:
+        data['redirects'] = [tuple(hop) for hop in cached_data.get('redirects', [])]
+    if extract_urls:
+        data['additional_urls'] = [tuple(link) for link in cached_data['additional_urls']]
+    return data
+
+
+def validate_urls(urls, validate, max_workers=1, max_workers_per_host=None, interleave_window=None,
+                  rate_limiter=None):
+    """Validate the URLs concurrently and yield (url, data) pairs in the same order as the given URLs.
+    URLs of hosts at max_workers_per_host or out of rate_limiter tokens wait in a queue per host
+    instead of taking up a worker."""
+    max_workers = max(1, max_workers or 1)
+    if max_workers == 1:
+        for url in urls:
+            while rate_limiter and (delay := rate_limiter.try_acquire(url)):
+                time.sleep(delay)
+            yield url, validate(url)
+        return
+
+    read_ahead = interleave_window or max_workers * 2
+    urls = iter(urls)
+    exhausted = False
+    read_count = 0
+    yield_count = 0
+    # URLs waiting to be submitted, per host, in the order the hosts were first seen
+    host_queues = {}
+    running_per_host = Counter()
+    running = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            while not exhausted and read_count - yield_count < read_ahead:
+                url = next(urls, None)
+                if url is None:
+                    exhausted = True
+                    break
+                host_queues.setdefault(extract_domain(url), deque()).append((read_count, url))
+                read_count += 1
+
+            # seconds until a host that is out of tokens gets its next one
+            delay = None
+            rate_limited = set()
+            while len(running) < max_workers:
+                hosts = [host for host in host_queues if host not in rate_limited and
+                         (not max_workers_per_host or running_per_host[host] < max_workers_per_host)]
+                if not hosts:
+                    break
+                if interleave_window:
+                    host = hosts[0]
+                else:
+                    host = min(hosts, key=lambda host: host_queues[host][0][0])
+                host_delay = rate_limiter.try_acquire(host_queues[host][0][1]) if rate_limiter else 0
+                if host_delay:
+                    rate_limited.add(host)
+                    delay = host_delay if delay is None else min(delay, host_delay)
+                    continue
+                # move the host to the back, so the hosts take turns
+                host_queue = host_queues.pop(host)
+                index, url = host_queue.popleft()
+                if host_queue:
+                    host_queues[host] = host_queue
+                future = executor.submit(validate, url)
+                futures[index] = (url, future)
+                running[future] = host
+                running_per_host[host] += 1
+
+            # yield the oldest URLs as soon as they are done
+            while yield_count in futures and futures[yield_count][1].done():
+                url, future = futures.pop(yield_count)
+                yield url, future.result()
+                yield_count += 1
+            if exhausted and yield_count == read_count:
+                return
+
+            if not running:
+                time.sleep(delay or 0)
+                continue
+            done, _ = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+            for future in done:
+                running_per_host[running.pop(future)] -= 1
+
+
+def build_rate_limiter(config):
+    """Create the HostRateLimiter from the politeness settings, or None if there are no limits."""
+    politeness = config.get('politeness', {})
+    if not (politeness.get('rate') or politeness.get('hosts') or politeness.get('respect_robots_txt')):
+        return None
+    return HostRateLimiter(rate=politeness.get('rate'), burst=politeness.get('burst', 1),
+                           host_rates=politeness.get('hosts'),
+                           respect_robots_txt=politeness.get('respect_robots_txt', False),
+                           timeout=config.get('timeout', 10))
+
+
+def build_session(config, redirects=None, max_workers=None):
+    """Create the PooledSession from the configuration. max_workers is the total number of
+    workers sharing the session (default is the max_workers of the config)."""
+    max_workers = max_workers or config.get('max_workers', 1)
+    return PooledSession(pool_connections=config.get('pool_connections', 100),
+                         pool_maxsize=config.get('pool_maxsize', max(10, max_workers)),
+                         max_retries=config.get('max_retries', 3),
+                         backoff_factor=config.get('backoff_factor', 0.5),
+                         max_retry_wait=config.get('max_retry_wait', 30),
+                         redirects=redirects)
+
+
+def validate_config(config, sitemap_url=None):
+    """Check the configuration settings, raising a ValueError for the first invalid one."""
+    if not (sitemap_url or config.get('sitemap_url')):
+        raise ValueError("'sitemap_url' is required but not provided, either in the configuration "
+                         "file or via the command line.")
+    html_parser = config.get('html_parser', 'lxml')
+    if html_parser not in HTML_PARSERS:
+        raise ValueError(f"unsupported 'html_parser' {html_parser}, expected one of {HTML_PARSERS}.")
+    for url_class, probe_mode in config.get('probe_mode', {}).items():
+        if probe_mode not in PROBE_MODES:
+            raise ValueError(f"unsupported 'probe_mode' {probe_mode} for {url_class} URLs, "
+                             f"expected one of {PROBE_MODES}.")
+    metrics_format = config.get('metrics_format', 'json')
+    if metrics_format not in METRICS_FORMATS:
+        raise ValueError(f"unsupported 'metrics_format' {metrics_format}, "
+                         f"expected one of {METRICS_FORMATS}.")
+    data_format = config.get('data_format') or get_data_format(config.get('data_file',
+                                                                            'sitemap_link_validation.csv'))
+    if data_format not in DATA_FORMATS:
+        raise ValueError(f"unsupported 'data_format' {data_format}, expected one of {DATA_FORMATS}.")
+
+
+def run_site(config, session, redirects, sitemap_url=None, resume=False, memo=None,
+             parse_pool=None, rate_limiter=None, caches=None):
+    """Validate the sitemap of a single site and write its results to its own results file.
+    caches maps cache files to the ValidationCache shared with other sites, if any."""
+    validate_config(config, sitemap_url)
+    sitemap_url = sitemap_url or config.get('sitemap_url')
+
+    urls_to_exclude = PatternMatcher(config.get('urls_to_exclude', []))
+    phrases_to_exclude = PatternMatcher(config.get('phrases_to_exclude', []), re.IGNORECASE)
     first_party_domains = config.get('first_party_domains', [extract_domain(sitemap_url)])
     request_timeout = config.get('timeout', 10)
     data_file = config.get('data_file', 'sitemap_link_validation.csv')
     extract_urls = config.get('extract_additional_urls', False)
-    all_additional_urls = set()
+    max_workers = config.get('max_workers', 1)
+    max_workers_per_host = config.get('max_workers_per_host', None)
+    html_parser = config.get('html_parser', 'lxml')
+    interleave_window = config.get('politeness', {}).get('interleave_window')
+    max_body_bytes = config.get('max_body_bytes', 10485760)
+    probe_modes = config.get('probe_mode', {})
+    cache_file = config.get('cache_file')
+    cache = None
+    if cache_file:
+        # cached results depend on the phrases to exclude, the parser, the probe modes and the
+        # maximum body size
+        namespace = json.dumps([phrases_to_exclude.patterns, html_parser, probe_modes,
+                                max_body_bytes], sort_keys=True)
+        namespace = hashlib.sha256(namespace.encode('utf-8')).hexdigest()
+        cache_ttl = config.get('cache_ttl', 86400)
+        if caches and cache_file in caches:
+            cache = caches[cache_file].with_namespace(namespace, cache_ttl)
+        else:
+            cache = ValidationCache(cache_file, ttl=cache_ttl, namespace=namespace)
+    checkpoint = CrawlCheckpoint(config.get('checkpoint_file', f'{data_file}.checkpoint'),
+                                 resume=resume)
+    # crawl mode follows first-party links past the first level of additional URLs
+    crawl = config.get('crawl')
+    max_depth = crawl.get('max_depth', 3) if crawl else 1
+    max_pages_per_host = crawl.get('max_pages_per_host') if crawl else None
+    url_key = normalize_url if crawl else str
+    spill_threshold = config.get('link_graph_spill_threshold', 1000000)
+    # link_graphs[depth] holds the links to the URLs at that depth, found on pages one level up
+    link_graphs = defaultdict(lambda: LinkGraph(spill_threshold))
+    for depth, source_url, links in checkpoint.links:
+        link_graphs[depth + 1].add_links(source_url, links)
 
-    # initialize CSV file with headers
-    with open(data_file, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['URL', 'Response Code', 'Exception', 'Details', 'Response Length',
-                        'Page Title', 'First Party', 'Link Text', 'Source URL'])
+    timing_columns = config.get('timing_columns', False)
+    redirect_columns = config.get('redirect_columns', False)
+    result_columns = {**RESULT_COLUMNS,
+                      **(REDIRECT_COLUMNS if redirect_columns else {}),
+                      **(TIMING_COLUMNS if timing_columns else {})}
+    redirect_report_file = config.get('redirect_report_file')
+    report_writer = None
+    if redirect_report_file:
+        report_writer = ResultWriter(redirect_report_file, columns=REDIRECT_REPORT_COLUMNS,
+                                     append=resume)
+    metrics = RunMetrics()
+    metrics_file = config.get('metrics_file')
+    metrics_format = config.get('metrics_format', 'json')
 
-    sitemap_response, exception, details = get_url(sitemap_url, request_timeout)
-    if sitemap_response:
-        urls = parse_sitemap(sitemap_response)
-        for url in urls:
-            data = validate_url(url, urls_to_exclude, phrases_to_exclude, first_party_domains, 
-                                request_timeout, extract_urls)
+    # initialize the results file with headers; rows are buffered and flushed periodically,
+    # and the checkpoint is synced after every flush
+    with ResultWriter(data_file, config.get('data_format'), columns=result_columns,
+                      flush_rows=config.get('flush_rows', 100),
+                      flush_interval=config.get('flush_interval', 5),
+                      append=resume, on_flush=checkpoint.flush) as writer:
+        validate = partial(validate_url, urls_to_exclude=urls_to_exclude,
+                           phrases_to_exclude=phrases_to_exclude,
+                           first_party_domains=first_party_domains, timeout=request_timeout,
+                           session=session, parser=html_parser, cache=cache,
+                           probe_modes=probe_modes, redirects=redirects,
+                           max_body_bytes=max_body_bytes, parse_pool=parse_pool)
+        if memo:
+            # results depend on the URL settings
+            settings_key = json.dumps([urls_to_exclude.patterns, phrases_to_exclude.patterns,
+                                       html_parser, probe_modes, request_timeout, max_body_bytes],
+                                      sort_keys=True)
+            validate = partial(validate_memoized, memo=memo, validate=validate,
+                               first_party_domains=first_party_domains, settings_key=settings_key)
+        # validation starts as soon as the first URLs are parsed from the sitemap
+        pending_urls = iter_pending_sitemap_urls(checkpoint, sitemap_url, request_timeout, session)
+        for url, data in validate_urls(pending_urls, partial(validate, extract_urls=extract_urls),
+                                       max_workers, max_workers_per_host, interleave_window,
+                                       rate_limiter):
             additional_urls = data.pop('additional_urls')
             data['link_text'] = url
             data['source_url'] = sitemap_url
-            write_data(data_file, **data)
+            checkpoint.complete(url, 0, additional_urls)
+            record_redirects(data, redirect_columns, report_writer)
+            write_data(writer, **record_timings(data, metrics, timing_columns))
             if additional_urls:
-                additional_urls = [(additional_url, link_text, url) for additional_url,
-                                   link_text in additional_urls]
-                all_additional_urls.update(additional_urls)
-        # after processing sitemap URLs, update and validate the additional URLs
-        if all_additional_urls:
-            all_additional_urls = [(url, link_text, source_url) for url, link_text, source_url
-                                   in all_additional_urls if url not in urls]
-            # combine link_text and source_url values for duplicate URLs
-            url_dict = {}
-            for url, link_text, source_url in all_additional_urls:
-                if url not in url_dict:
-                    url_dict[url] = {'link_text': [link_text], 'source_url': [source_url]}
-                else:
-                    url_dict[url]['link_text'].append(link_text)
-                    url_dict[url]['source_url'].append(source_url)
-            logging.info(f'Extracted {len(url_dict)} additional unique URLs.')
-            # process each additional URL
-            for url, content in url_dict.items():
-                data = validate_url(url, urls_to_exclude, phrases_to_exclude, first_party_domains, 
-                                    request_timeout, False)
+                link_graphs[1].add_links(url, additional_urls)
+
+        # after processing sitemap URLs, validate the additional URLs level by level, combining
+        # the link_text and source_url values of all the links to each URL
+        visited = {url_key(url) for url in checkpoint.frontier}
+        pages_per_host = Counter(extract_domain(url) for url in checkpoint.frontier)
+        depth = 1
+        while depth <= max_depth and depth in link_graphs:
+            link_graph = link_graphs[depth]
+
+            def iter_level_urls():
+                """Yield the URLs at this depth that haven't been visited or completed yet."""
+                for url in link_graph.targets():
+                    key = url_key(url)
+                    if key in visited:
+                        continue
+                    visited.add(key)
+                    domain = extract_domain(url)
+                    if max_pages_per_host and pages_per_host[domain] >= max_pages_per_host:
+                        logging.info(f'Skipping {url} as {domain} reached the page limit.')
+                        continue
+                    pages_per_host[domain] += 1
+                    if not checkpoint.is_completed(url, depth):
+                        yield url
+
+            def validate_level_url(url, depth=depth):
+                """Validate the URL, extracting its links if the crawl continues from it. Pages
+                of a crawled site are always fully checked, other URLs use the probe mode."""
+                crawled = bool(crawl) and is_url_first_party(url, first_party_domains)
+                return validate(url, extract_urls=crawled and depth < max_depth, probe=not crawled)
+
+            logging.info(f'Validating additional URLs at depth {depth}...')
+            for url, data in validate_urls(iter_level_urls(), validate_level_url,
+                                           max_workers, max_workers_per_host, interleave_window,
+                                           rate_limiter):
                 additional_urls = data.pop('additional_urls')
-                data['link_text'] = content['link_text']
-                data['source_url'] = content['source_url']
-                write_data(data_file, **data)
+                data['link_text'], data['source_url'] = link_graph.incoming(url)
+                checkpoint.complete(url, depth, additional_urls)
+                record_redirects(data, redirect_columns, report_writer)
+                write_data(writer, **record_timings(data, metrics, timing_columns))
+                if additional_urls:
+                    link_graphs[depth + 1].add_links(url, additional_urls)
+            link_graphs.pop(depth).close()
+            depth += 1
+    for link_graph in link_graphs.values():
+        link_graph.close()
+    if report_writer:
+        report_writer.close()
+        logging.info(f'Links that go through redirects written to: {redirect_report_file}')
+    checkpoint.close()
+    summary = metrics.summary()
+    logging.info(f'Validated {summary["urls"]} URLs in {summary["elapsed_seconds"]:.1f} seconds '
+                 f'({summary["urls_per_second"]:.1f} URLs per second, {summary["bytes"]} bytes).')
+    if summary['slowest']:
+        logging.info(f'Slowest URL: {summary["slowest"][0]["url"]} '
+                     f'({summary["slowest"][0]["seconds"]:.2f} seconds).')
+    if metrics_file:
+        metrics.export(metrics_file, metrics_format)
+    if cache and not (caches and cache_file in caches):
+        cache.close()
+
+
+def validate_memoized(url, extract_urls, memo, validate, first_party_domains, settings_key,
+                      probe=False):
+    """Validate the URL through the ResultMemo shared between sites, if it is third-party."""
+    if is_url_first_party(url, first_party_domains):
+        return validate(url, extract_urls=extract_urls, probe=probe)
+    return memo.get((url, extract_urls, probe, settings_key),
+                    partial(validate, url, extract_urls=extract_urls, probe=probe))
+
+
+def main():
+    """Main entry point for the script."""
+    parser = argparse.ArgumentParser(description="Validate URLs from a sitemap.")
+    parser.add_argument('--config', nargs='+', default=['config.json'],
+                        help='Path to the configuration file, or several files to validate '
+                             'their sites at the same time.')
+    parser.add_argument('--sitemap_url', help="URL of the sitemap to validate.")
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted run from its checkpoint file.')
+    args = parser.parse_args()
+    configs = [load_config(config_file) for config_file in args.config]
+    if args.sitemap_url and len(configs) > 1:
+        logging.error("Error: '--sitemap_url' can only be used with a single configuration file.")
+        sys.exit(1)
+    data_files = [config.get('data_file', 'sitemap_link_validation.csv') for config in configs]
+    if len(set(data_files)) < len(data_files):
+        logging.error("Error: each configuration file needs its own 'data_file'.")
+        sys.exit(1)
+    # check every configuration before any site starts, so a bad one doesn't stop the batch midway
+    for config_file, config in zip(args.config, configs):
+        try:
+            validate_config(config, args.sitemap_url)
+        except ValueError as e:
+            logging.error(f'Error in {config_file}: {e}')
+            sys.exit(1)
+
+    # the connection pool, the permanent redirects and the parse workers are shared by all
+    # sites; the pool, retry, politeness and parse worker settings are taken from the first
+    # configuration file
+    redirects = RedirectCache()
+    rate_limiter = build_rate_limiter(configs[0])
+    session = build_session(configs[0], redirects,
+                            sum(config.get('max_workers', 1) for config in configs))
+    # pages are parsed in worker processes if parse_workers is set
+    parse_workers = configs[0].get('parse_workers', 0)
+    parse_pool = None
+    if parse_workers:
+        phrase_matchers = [PatternMatcher(config.get('phrases_to_exclude', []), re.IGNORECASE)
+                           for config in configs]
+        parse_pool = ParsePool(parse_workers, configs[0].get('parse_queue_size'), phrase_matchers)
+    # sites with the same cache file share its connection, so their writes don't lock each other out
+    caches = {}
+    for config in configs:
+        cache_file = config.get('cache_file')
+        if cache_file and cache_file not in caches:
+            caches[cache_file] = ValidationCache(cache_file)
+    try:
+        if len(configs) == 1:
+            run_site(configs[0], session, redirects, args.sitemap_url, args.resume,
+                     parse_pool=parse_pool, rate_limiter=rate_limiter, caches=caches)
+        else:
+            memo = ResultMemo()
+            with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+                futures = [executor.submit(run_site, config, session, redirects, resume=args.resume,
+                                           memo=memo, parse_pool=parse_pool, rate_limiter=rate_limiter,
+                                           caches=caches)
+                           for config in configs]
+                for config_file, future in zip(args.config, futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f'Failed to validate the site in {config_file}. Details: {e}')
+            logging.info(f'Validated {len(configs)} sites, reusing {memo.hits} results between sites.')
+        if redirects.hops_skipped:
+            logging.info(f'Skipped {redirects.hops_skipped} redirects using the redirect cache.')
+        logging.info(f'Connection pool stats: {session.stats()}')
+    finally:
+        session.close()
+        if rate_limiter:
+            rate_limiter.close()
+        if parse_pool:
+            parse_pool.close()
+        for cache in caches.values():
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -1,28 +1,107 @@
 import os
+import time
+import queue
 import shutil
 import sqlite3
 import logging
 import selenium
 import tempfile
+import numpy as np
 import pandas as pd
+import urllib.request
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from Crypto.Cipher import AES
 from Crypto.Protocol.KDF import PBKDF2
-from datetime import datetime, timedelta
-from urllib.parse import unquote
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, unquote
 from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver import FirefoxOptions, ChromeOptions
 from selenium.webdriver.chrome.service import Service
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is only needed for Parquet and Feather exports
+    pa = None
+
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
 
+WIN_EPOCH_TO_UNIX_OFFSET = 11644473600
+MICROSECONDS_IN_SECOND = 1000000
+AES_BLOCK_SIZE = 16
+CHROME_IV = b' ' * AES_BLOCK_SIZE
+READY_STRATEGIES = ('ready_state', 'network_idle', 'cookie_stable', 'settle')
+SNAPSHOT_KEY_COLUMNS = ['host', 'name', 'path']
+SNAPSHOT_DIFF_FIELDS = ['value', 'expiry', 'sameSite', 'secure', 'httpOnly']
+SNAPSHOT_COLUMNS = SNAPSHOT_KEY_COLUMNS + SNAPSHOT_DIFF_FIELDS
+# column names of the database cookie methods that differ from the webdriver ones
+SNAPSHOT_COLUMN_ALIASES = {
+    'domain': 'host',
+    'isSecure': 'secure',
+    'isHttpOnly': 'httpOnly',
+    'decryptedValue': 'value'
+}
+SNAPSHOT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scans (
+    scan_id INTEGER PRIMARY KEY,
+    scanned_at TEXT NOT NULL,
+    browser_type TEXT NOT NULL,
+    cookie_method TEXT NOT NULL,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scans_scanned_at ON scans (scanned_at);
+CREATE INDEX IF NOT EXISTS scans_source ON scans (source, browser_type, cookie_method, scanned_at);
+CREATE TABLE IF NOT EXISTS cookies (
+    scan_id INTEGER NOT NULL REFERENCES scans (scan_id) ON DELETE CASCADE,
+    host TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    value TEXT,
+    expiry INTEGER,
+    sameSite TEXT,
+    secure INTEGER,
+    httpOnly INTEGER,
+    PRIMARY KEY (scan_id, host, name, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cookies_key ON cookies (host, name, path, scan_id);
+'''
+
+# resolves once the page's load event has fired
+WAIT_FOR_LOAD_SCRIPT = '''
+const done = arguments[arguments.length - 1];
+if (document.readyState === 'complete') {
+    done(true);
+} else {
+    window.addEventListener('load', () => done(true), {once: true});
+}
+'''
+
+# resolves once no resource has finished loading for arguments[0] milliseconds after the load event
+WAIT_FOR_NETWORK_IDLE_SCRIPT = '''
+const idleTime = arguments[0];
+const done = arguments[arguments.length - 1];
+let timer = null;
+const observer = new PerformanceObserver(() => restart());
+const restart = () => {
+    clearTimeout(timer);
+    timer = setTimeout(() => { observer.disconnect(); done(true); }, idleTime);
+};
+observer.observe({type: 'resource'});
+if (document.readyState === 'complete') {
+    restart();
+} else {
+    window.addEventListener('load', restart, {once: true});
+}
+'''
+
 
 def win_to_unix_epoch(win_epoch):
     """Convert Windows epoch to Unix epoch and return Unix epoch."""
-    WIN_EPOCH_TO_UNIX_OFFSET = 11644473600
-    MICROSECONDS_IN_SECOND = 1000000
-
     if not isinstance(win_epoch, (int, float)):
         raise ValueError('win_epoch must be an integer or float.')
 
@@ -30,6 +109,21 @@ def win_to_unix_epoch(win_epoch):
     return unix_epoch
 
 
+def win_to_unix_epochs(win_epochs):
+    """Convert a Series of Windows epochs to Unix epochs at once, with the same results as
+    applying win_to_unix_epoch to each value."""
+    if pd.api.types.is_integer_dtype(win_epochs):
+        # Chrome timestamps are too large to convert to float exactly, so the whole seconds and
+        # microseconds are split first to round the same way as Python's int / int division
+        seconds, microseconds = np.divmod(win_epochs.to_numpy(dtype=np.int64), MICROSECONDS_IN_SECOND)
+        unix_epochs = (seconds + microseconds / MICROSECONDS_IN_SECOND) - WIN_EPOCH_TO_UNIX_OFFSET
+    elif pd.api.types.is_float_dtype(win_epochs):
+        unix_epochs = (win_epochs.to_numpy() / MICROSECONDS_IN_SECOND) - WIN_EPOCH_TO_UNIX_OFFSET
+    else:
+        raise ValueError('win_epoch must be an integer or float.')
+    return pd.Series(unix_epochs, index=win_epochs.index, name=win_epochs.name)
+
+
 def setup_driver(browser_type, headless=False):
     """Setup the webdriver with necessary options for given browser type."""
     try:
@@ -39,6 +133,8 @@ def setup_driver(browser_type, headless=False):
             options = FirefoxOptions()
             if headless:
                 options.add_argument('--headless')
+            # allows the chrome context used by clear_cookies() to clear the whole cookie jar
+            options.add_argument('-remote-allow-system-access')
             driver = webdriver.Firefox(options=options)
             profile_dir = driver.capabilities['moz:profile']
 
@@ -68,6 +164,47 @@ def setup_driver(browser_type, headless=False):
         raise
 
 
+def wait_for_page_ready(driver, strategy='ready_state', timeout=45, idle_time=0.5, settle_time=2,
+                        stable_time=1, poll_interval=0.25):
+    """Wait until the page is ready to read its cookies and return the seconds waited.
+
+    Strategies:
+    - ready_state waits for the load event.
+    - network_idle also waits until no resources have loaded for idle_time seconds, to catch
+      cookies set by late third-party scripts.
+    - cookie_stable waits for the load event, then until the number of cookies hasn't changed
+      for stable_time seconds (checked every poll_interval seconds).
+    - settle waits for the load event, then a fixed settle_time seconds.
+    If the page isn't ready within timeout seconds, a warning is logged and the wait ends."""
+    if strategy not in READY_STRATEGIES:
+        raise ValueError(f'Unsupported page ready strategy: {strategy}')
+    start = time.monotonic()
+    try:
+        driver.set_script_timeout(timeout)
+        if strategy == 'network_idle':
+            driver.execute_async_script(WAIT_FOR_NETWORK_IDLE_SCRIPT, int(idle_time * 1000))
+        else:
+            driver.execute_async_script(WAIT_FOR_LOAD_SCRIPT)
+
+        if strategy == 'settle':
+            time.sleep(max(0, min(settle_time, timeout - (time.monotonic() - start))))
+        elif strategy == 'cookie_stable':
+            cookie_count = len(driver.get_cookies())
+            stable_since = time.monotonic()
+            while time.monotonic() - stable_since < stable_time:
+                if time.monotonic() - start >= timeout:
+                    raise selenium.common.exceptions.TimeoutException('cookies did not stabilize')
+                time.sleep(poll_interval)
+                new_count = len(driver.get_cookies())
+                if new_count != cookie_count:
+                    cookie_count, stable_since = new_count, time.monotonic()
+    except selenium.common.exceptions.TimeoutException as e:
+        logging.warning(f'Page was not ready ({strategy}) after {timeout} seconds, continuing. Details: {e}')
+    elapsed = time.monotonic() - start
+    logging.info(f'Page ready ({strategy}) after {elapsed:.2f} seconds.')
+    return elapsed
+
+
 def get_cookies(driver, browser_type, cookie_method, profile_dir):
     """Call the appropriate get_cookies_ function based on the given cookie_method."""
     logging.info(f'Getting cookies using the {cookie_method} method...')
@@ -95,44 +232,70 @@ def get_cookies_wd(driver):
         raise
 
 
-def get_cookies_db(browser_type, profile_dir):
-    """Get cookies from the given browser's cookie database and return the data in a DataFrame."""
+def get_cookies_db(browser_type, profile_dir, chunk_size=5000):
+    """Get cookies from the given browser's cookie database and return the data in a DataFrame.
+    The database is read in place, or from a copy if it is locked."""
     try:
         if browser_type == 'firefox':
-            query = 'SELECT * FROM moz_cookies'
+            table = 'moz_cookies'
             database_path = f'{profile_dir}/cookies.sqlite'
-            temp_db = f'{os.getcwd()}/cookies.sqlite'
+            unused_cols = ['id', 'rawSameSite']
         elif browser_type == 'chrome':
-            query = 'SELECT * FROM cookies'
+            table = 'cookies'
             database_path = f'{profile_dir}/Default/Cookies'
-            temp_db = f'{os.getcwd()}/Cookies'
+            unused_cols = ['top_frame_site_key']
         else:
             raise ValueError(f'Unsupported browser: {browser_type}')
 
         if not os.path.exists(database_path):
             raise ValueError(f'Cookies database not found at: {database_path}')
 
-        shutil.copy(database_path, temp_db)
-        conn = sqlite3.connect(temp_db)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        cols = [description[0] for description in cursor.description]
-        os.remove(temp_db)
+        try:
+            conn = sqlite3.connect(f'file:{quote(os.path.abspath(database_path))}?mode=ro&immutable=1',
+                                   uri=True)
+            return read_cookies_table(conn, table, unused_cols, chunk_size)
+        except sqlite3.DatabaseError as e:
+            logging.info(f'Unable to read cookies database in place, reading a copy instead. Details: {e}')
 
-        return pd.DataFrame(data=rows, columns=cols)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_db = shutil.copy(database_path, temp_dir)
+            conn = sqlite3.connect(temp_db)
+            return read_cookies_table(conn, table, unused_cols, chunk_size)
     except Exception as e:
         logging.error(f'Encountered error getting cookies from database. Details: {e}')
         raise
 
 
+def read_cookies_table(conn, table, unused_cols=(), chunk_size=5000):
+    """Read the columns of the cookies table (except unused_cols) into a DataFrame, chunk_size
+    rows at a time, and close the connection."""
+    try:
+        cols = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')
+                if row[1] not in unused_cols]
+        if not cols:
+            raise sqlite3.OperationalError(f'no such table: {table}')
+        quoted_cols = ', '.join(f'"{col}"' for col in cols)
+        # each chunk is converted to typed columns before the next one is read
+        chunks = list(pd.read_sql_query(f'SELECT {quoted_cols} FROM {table}', conn, chunksize=chunk_size))
+        if not chunks:
+            return pd.DataFrame(columns=cols)
+        return pd.concat(chunks, ignore_index=True)
+    finally:
+        conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_decryption_key():
+    """Derive the key for v10 encrypted Chrome cookies (only derived once)."""
+    return PBKDF2(password='peanuts'.encode('utf-8'), salt=b'saltysalt', dkLen=16, count=1)
+
+
 def decrypt_value(encrypted_value):
     """Decrypts an encrypted value based on its version and returns the decrypted string."""
     try:
         version, encrypted_value = encrypted_value[:3].decode().lower(), encrypted_value[3:]
         if version.lower() == 'v10':
-            key = PBKDF2(password='peanuts'.encode('utf-8'), salt=b'saltysalt', dkLen=16, count=1)
-            cipher = AES.new(key, AES.MODE_CBC, IV=b' ' * 16)
+            cipher = AES.new(get_decryption_key(), AES.MODE_CBC, IV=CHROME_IV)
             decrypted = cipher.decrypt(encrypted_value)
             padding_length = decrypted[-1]
             return decrypted[32:-padding_length].decode('utf-8')
@@ -143,6 +306,45 @@ def decrypt_value(encrypted_value):
         raise
 
 
+def decrypt_values(encrypted_values, batch_size=4096):
+    """Decrypt a Series of encrypted values in batches and return a Series of decrypted strings,
+    with the same results as applying decrypt_value to each value.
+
+    The CBC decryption of a whole batch is done at once: all ciphertexts are decrypted with a
+    single AES-ECB call, and each block is then XORed with the ciphertext block before it (or
+    the IV, for the first block of each value)."""
+    try:
+        decrypted_values = []
+        ecb_cipher = AES.new(get_decryption_key(), AES.MODE_ECB)
+        for start in range(0, len(encrypted_values), batch_size):
+            batch = encrypted_values.iloc[start:start + batch_size]
+            ciphertexts = []
+            for encrypted_value in batch:
+                version = encrypted_value[:3].decode().lower()
+                if version != 'v10':
+                    raise ValueError(f'Unsupported cookie encryption version: {version}')
+                if (len(encrypted_value) - 3) % AES_BLOCK_SIZE:
+                    raise ValueError('Data must be padded to 16 byte boundary in CBC mode')
+                ciphertexts.append(encrypted_value[3:])
+
+            joined = b''.join(ciphertexts)
+            previous = b''.join(CHROME_IV + ciphertext[:-AES_BLOCK_SIZE] for ciphertext in ciphertexts
+                                if ciphertext)
+            decrypted = (np.frombuffer(ecb_cipher.decrypt(joined), dtype=np.uint8) ^
+                         np.frombuffer(previous, dtype=np.uint8)).tobytes()
+
+            offset = 0
+            for ciphertext in ciphertexts:
+                value = decrypted[offset:offset + len(ciphertext)]
+                offset += len(ciphertext)
+                padding_length = value[-1]
+                decrypted_values.append(value[32:-padding_length].decode('utf-8'))
+        return pd.Series(decrypted_values, index=encrypted_values.index)
+    except Exception as e:
+        logging.error(f'Encountered error decrypting cookie values. Details: {e}')
+        raise
+
+
 def format_cookies_chrome(df):
     """Format given cookies dataframe for chrome browser_type."""
     try:
@@ -177,10 +379,10 @@ def format_cookies_chrome(df):
 
         time_cols = ['creation_utc', 'expires_utc', 'last_access_utc', 'last_update_utc']
         df[time_cols] = df[time_cols].apply(lambda col: pd.to_datetime(
-                col.apply(win_to_unix_epoch), unit='s', utc=True, errors='coerce').dt.tz_localize(None)
+                win_to_unix_epochs(col), unit='s', utc=True, errors='coerce').dt.tz_localize(None)
             )
 
-        df['decryptedValue'] = df['encrypted_value'].apply(decrypt_value).fillna(df['value'])
+        df['decryptedValue'] = decrypt_values(df['encrypted_value']).fillna(df['value'])
         cols_to_rename = {
             'is_secure': 'isSecure',
             'is_httponly': 'isHttpOnly',
@@ -198,7 +400,7 @@ def format_cookies_chrome(df):
         }
         df.rename(columns=cols_to_rename, inplace=True)
         cols_to_drop = ['top_frame_site_key', 'samesite', 'value', 'encrypted_value']
-        df.drop(columns=cols_to_drop, inplace=True)
+        df.drop(columns=cols_to_drop, inplace=True, errors='ignore')
         return df
     except Exception as e:
         logging.error(f'Encountered error formatting cookies. Details: {e}')
@@ -236,7 +438,7 @@ def format_cookies_firefox(df):
         }
         df.rename(columns=cols_to_rename, inplace=True)
         cols_to_drop = ['id', 'rawSameSite']
-        df.drop(columns=cols_to_drop, inplace=True)
+        df.drop(columns=cols_to_drop, inplace=True, errors='ignore')
         return df
     except Exception as e:
         logging.error(f'Encountered error formatting cookies. Details: {e}')
@@ -254,6 +456,329 @@ def export_cookies(df, excel_writer, **kwargs):
         raise
 
 
+class CookieExporter:
+    """Base class for exporters that write cookies to a file incrementally.
+
+    Call append() with each batch of cookies (e.g. the cookies of each page) and close() at the
+    end. The columns are fixed by the columns argument or, if it isn't given, by the first
+    batch: missing columns are left empty and extra columns are dropped."""
+
+    def __init__(self, export_file, columns=None):
+        self.export_file = export_file
+        self.columns = list(columns) if columns is not None else None
+        self.rows = 0
+
+    def append(self, df):
+        """Write the batch of cookies to the export file."""
+        if df.empty:
+            return
+        if self.columns is None:
+            self.columns = list(df.columns)
+        extra_cols = [col for col in df.columns if col not in self.columns]
+        if extra_cols:
+            logging.warning(f'Dropping columns missing from the first batch of cookies: {extra_cols}')
+        self._write(df.reindex(columns=self.columns))
+        self.rows += len(df)
+
+    def _write(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        """Finish writing the export file."""
+        logging.info(f'{self.rows} cookies exported to: {self.export_file}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvExporter(CookieExporter):
+    """Append cookies to a CSV file."""
+
+    def _write(self, df):
+        df.to_csv(self.export_file, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+
+
+class JsonLinesExporter(CookieExporter):
+    """Append cookies to a JSON Lines file, one cookie per line."""
+
+    def _write(self, df):
+        with open(self.export_file, 'a' if self.rows else 'w') as file:
+            df.to_json(file, orient='records', lines=True, date_format='iso')
+
+
+class ArrowExporter(CookieExporter):
+    """Base class for exporters of Arrow-based formats. The Arrow schema is taken from the first
+    batch, with text and mixed-type columns (such as expiry) stored as strings."""
+
+    def __init__(self, export_file, columns=None):
+        if pa is None:
+            raise ImportError('pyarrow is required to export cookies to Parquet or Feather files.')
+        super().__init__(export_file, columns)
+        self.schema = None
+        self._writer = None
+
+    def _write(self, df):
+        df = df.copy()
+        for col in df.columns:
+            if self.schema is None:
+                as_string = df[col].dtype == object or pd.api.types.is_string_dtype(df[col])
+            else:
+                field_type = self.schema.field(col).type
+                as_string = pa.types.is_string(field_type) or pa.types.is_large_string(field_type)
+            if as_string:
+                df[col] = df[col].astype(str).where(df[col].notna(), None)
+        if self.schema is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.schema = table.schema
+            self._writer = self._open_writer()
+        else:
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def _open_writer(self):
+        raise NotImplementedError
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+        super().close()
+
+
+class ParquetExporter(ArrowExporter):
+    """Append cookies to a Parquet file, one row group per batch."""
+
+    def _open_writer(self):
+        return pq.ParquetWriter(self.export_file, self.schema)
+
+
+class FeatherExporter(ArrowExporter):
+    """Append cookies to a Feather (Arrow IPC) file, one record batch per batch."""
+
+    def _open_writer(self):
+        return pa.ipc.new_file(self.export_file, self.schema)
+
+
+class ExcelExporter(CookieExporter):
+    """Collect cookies and write them to an Excel file when closed, since Excel files can't be
+    appended to."""
+
+    def __init__(self, export_file, columns=None):
+        super().__init__(export_file, columns)
+        self._batches = []
+
+    def _write(self, df):
+        self._batches.append(df)
+
+    def close(self):
+        if not self._batches:
+            logging.info('No cookies to export.')
+            return
+        export_cookies(pd.concat(self._batches, ignore_index=True), self.export_file, index=False)
+
+
+EXPORTERS = {
+    '.csv': CsvExporter,
+    '.jsonl': JsonLinesExporter,
+    '.parquet': ParquetExporter,
+    '.feather': FeatherExporter,
+    '.xlsx': ExcelExporter
+}
+
+
+def get_exporter(export_file, columns=None):
+    """Return the exporter for the export file, based on its extension."""
+    extension = os.path.splitext(export_file)[1].lower()
+    if extension not in EXPORTERS:
+        raise ValueError(f'Unsupported export file type: {extension}')
+    return EXPORTERS[extension](export_file, columns)
+
+
+def read_export(export_file):
+    """Read an export file (in any of the exporter formats) into a DataFrame."""
+    extension = os.path.splitext(export_file)[1].lower()
+    if extension == '.csv':
+        return pd.read_csv(export_file)
+    elif extension == '.jsonl':
+        return pd.read_json(export_file, orient='records', lines=True)
+    elif extension == '.parquet':
+        return pd.read_parquet(export_file)
+    elif extension == '.feather':
+        return pd.read_feather(export_file)
+    elif extension == '.xlsx':
+        return pd.read_excel(export_file)
+    raise ValueError(f'Unsupported export file type: {extension}')
+
+
+def convert_to_excel(export_file, excel_file):
+    """Convert an export file to an Excel file."""
+    logging.info(f'Converting {export_file} to Excel...')
+    export_cookies(read_export(export_file), excel_file, index=False)
+
+
+def to_unix_seconds(expiry):
+    """Convert a cookie expiry (Unix seconds, a datetime or 'session') to Unix seconds."""
+    if expiry is None or (isinstance(expiry, str) and expiry == 'session') or pd.isna(expiry):
+        return None
+    if isinstance(expiry, datetime):
+        # the formatted database expiries are naive UTC datetimes
+        return int(pd.Timestamp(expiry).timestamp())
+    return int(expiry)
+
+
+def to_utc_isoformat(dt):
+    """Format a datetime (naive ones are taken as UTC) as a sortable UTC ISO 8601 string."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat(timespec='seconds')
+
+
+def normalize_cookies(df):
+    """Return the snapshot columns (see SNAPSHOT_COLUMNS) of the given cookies, whichever browser and
+    cookie method they were read with. Expiries are converted to Unix seconds, None for session cookies."""
+    if 'decryptedValue' in df.columns:
+        df = df.drop(columns='value', errors='ignore')
+    df = df.rename(columns=SNAPSHOT_COLUMN_ALIASES)
+    normalized = pd.DataFrame({col: df[col] if col in df.columns else None for col in SNAPSHOT_COLUMNS},
+                              index=df.index)
+
+    expiry = normalized['expiry'].astype(object)
+    if 'hasExpires' in df.columns:
+        # chrome stores session cookies with an empty expiry date
+        expiry = expiry.where(df['hasExpires'].astype(bool), None)
+    normalized['expiry'] = pd.array(expiry.map(to_unix_seconds), dtype='Int64')
+    for col in ['secure', 'httpOnly']:
+        normalized[col] = pd.array(normalized[col].map(lambda flag: None if pd.isna(flag) else int(bool(flag))),
+                                   dtype='Int64')
+    normalized['sameSite'] = normalized['sameSite'].replace('', None)
+    normalized['path'] = normalized['path'].fillna('/')
+    return normalized.dropna(subset=['host', 'name'])
+
+
+class CookieSnapshotStore:
+    """Store the cookies of each scan in a SQLite database, to compare scans over time. Cookies are
+    keyed by scan, host, name and path, so diffs between two scans only read those two scans,
+    however many scans are stored. Changes are committed when used as a context manager."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.executescript(SNAPSHOT_SCHEMA)
+
+    def start_scan(self, browser_type, cookie_method, source, scanned_at=None):
+        """Add a scan of the given source (a URL or scan_source) and return its ID."""
+        scanned_at = to_utc_isoformat(scanned_at or datetime.now(timezone.utc))
+        cursor = self.conn.execute(
+            'INSERT INTO scans (scanned_at, browser_type, cookie_method, source) VALUES (?, ?, ?, ?)',
+            (scanned_at, browser_type, cookie_method, source))
+        return cursor.lastrowid
+
+    def add_cookies(self, scan_id, df):
+        """Add cookies to a scan. A cookie seen on several pages of the scan is stored once."""
+        normalized = normalize_cookies(df)
+        rows = normalized.astype(object).where(normalized.notna(), None).itertuples(index=False, name=None)
+        self.conn.executemany(
+            f'INSERT OR REPLACE INTO cookies (scan_id, {", ".join(SNAPSHOT_COLUMNS)}) '
+            f'VALUES (?, {", ".join("?" * len(SNAPSHOT_COLUMNS))})',
+            ((scan_id, *row) for row in rows))
+
+    def save(self, df, browser_type, cookie_method, source, scanned_at=None):
+        """Store the cookies as a new scan and return its ID."""
+        scan_id = self.start_scan(browser_type, cookie_method, source, scanned_at)
+        self.add_cookies(scan_id, df)
+        self.conn.commit()
+        return scan_id
+
+    def scans(self, since=None, until=None):
+        """Return the scans between the given datetimes (all scans by default), with their number of
+        cookies, in a DataFrame."""
+        conditions, params = ['1'], []
+        if since:
+            conditions.append('scanned_at >= ?')
+            params.append(to_utc_isoformat(since))
+        if until:
+            conditions.append('scanned_at <= ?')
+            params.append(to_utc_isoformat(until))
+        return pd.read_sql_query(
+            'SELECT scans.*, (SELECT COUNT(*) FROM cookies WHERE cookies.scan_id = scans.scan_id) AS cookies '
+            f'FROM scans WHERE {" AND ".join(conditions)} ORDER BY scanned_at, scan_id',
+            self.conn, params=params)
+
+    def previous_scan_id(self, scan_id):
+        """Return the ID of the last scan before the given one with the same source, browser type and
+        cookie method, or None if there is none."""
+        row = self.conn.execute(
+            'SELECT previous.scan_id FROM scans AS scan JOIN scans AS previous '
+            'ON previous.source = scan.source AND previous.browser_type = scan.browser_type '
+            'AND previous.cookie_method = scan.cookie_method '
+            'AND (previous.scanned_at, previous.scan_id) < (scan.scanned_at, scan.scan_id) '
+            'WHERE scan.scan_id = ? ORDER BY previous.scanned_at DESC, previous.scan_id DESC LIMIT 1',
+            (scan_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_snapshot(self, scan_id):
+        """Return the cookies of a scan in a DataFrame."""
+        return pd.read_sql_query(f'SELECT {", ".join(SNAPSHOT_COLUMNS)} FROM cookies WHERE scan_id = ?',
+                                 self.conn, params=(scan_id,))
+
+    def cookie_history(self, host, name, path='/'):
+        """Return every stored scan of a cookie, oldest first, in a DataFrame."""
+        return pd.read_sql_query(
+            f'SELECT scans.scan_id, scans.scanned_at, scans.source, {", ".join(SNAPSHOT_DIFF_FIELDS)} '
+            'FROM cookies JOIN scans USING (scan_id) WHERE host = ? AND name = ? AND path = ? '
+            'ORDER BY scans.scanned_at, scans.scan_id',
+            self.conn, params=(host, name, path))
+
+    def diff(self, old_scan_id, new_scan_id, fields=SNAPSHOT_DIFF_FIELDS):
+        """Compare two scans and return a dictionary of DataFrames:
+        - added: the cookies only in the new scan.
+        - removed: the cookies only in the old scan.
+        - changed: one row per changed field of the cookies in both scans, with the old and new values."""
+        columns = ', '.join(SNAPSHOT_COLUMNS)
+        key_match = ' AND '.join(f'other.{col} = cookie.{col}' for col in SNAPSHOT_KEY_COLUMNS)
+        only_in = (f'SELECT {columns} FROM cookies AS cookie WHERE cookie.scan_id = ? AND NOT EXISTS '
+                   f'(SELECT 1 FROM cookies AS other WHERE other.scan_id = ? AND {key_match})')
+        changed = ' UNION ALL '.join(
+            f"SELECT cookie.host, cookie.name, cookie.path, '{field}' AS field, "
+            f'cookie.{field} AS old, other.{field} AS new '
+            f'FROM cookies AS cookie JOIN cookies AS other ON other.scan_id = ? AND {key_match} '
+            f'WHERE cookie.scan_id = ? AND cookie.{field} IS NOT other.{field}'
+            for field in fields)
+        return {
+            'added': pd.read_sql_query(only_in, self.conn, params=(new_scan_id, old_scan_id)),
+            'removed': pd.read_sql_query(only_in, self.conn, params=(old_scan_id, new_scan_id)),
+            'changed': pd.read_sql_query(changed, self.conn, params=(new_scan_id, old_scan_id) * len(fields))
+        }
+
+    def log_diff(self, scan_id):
+        """Log how the cookies of a scan differ from the previous scan of the same source."""
+        previous_scan_id = self.previous_scan_id(scan_id)
+        if previous_scan_id is None:
+            logging.info('No previous snapshot to compare cookies with.')
+            return None
+        diff = self.diff(previous_scan_id, scan_id)
+        changed = diff['changed'].drop_duplicates(subset=SNAPSHOT_KEY_COLUMNS)
+        logging.info(f'Compared to snapshot {previous_scan_id}: {len(diff["added"])} cookies added, '
+                     f'{len(diff["removed"])} removed, {len(changed)} changed.')
+        return diff
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.close()
+
+
 def add_sample_cookies(driver):
     """Add sample cookies to the given WebDriver instance."""
     logging.info('Adding sample cookies...')
@@ -286,6 +811,162 @@ def add_sample_cookies(driver):
     return driver
 
 
+def load_urls(source, timeout=30):
+    """Load the URLs to scan from a sitemap (if source is a URL) or a text file with one URL
+    per line (blank lines and lines starting with # are skipped)."""
+    try:
+        if source.startswith(('http://', 'https://')):
+            with urllib.request.urlopen(source, timeout=timeout) as response:
+                root = ET.parse(response).getroot()
+            if root.tag.endswith('sitemapindex'):
+                urls = []
+                for loc in root.iterfind('{*}sitemap/{*}loc'):
+                    urls.extend(load_urls(loc.text.strip(), timeout))
+                return urls
+            return [loc.text.strip() for loc in root.iterfind('{*}url/{*}loc')]
+
+        with open(source) as file:
+            return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    except Exception as e:
+        logging.error(f'Encountered error loading URLs from {source}. Details: {e}')
+        raise
+
+
+def clear_cookies(driver, browser_type):
+    """Delete the cookies from the given WebDriver, so the next page starts without cookies."""
+    # delete_all_cookies only deletes the cookies of the current domain
+    driver.delete_all_cookies()
+    if browser_type == 'chrome':
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    elif browser_type == 'firefox':
+        try:
+            with driver.context(driver.CONTEXT_CHROME):
+                driver.execute_script('Services.cookies.removeAll();')
+        except selenium.common.exceptions.WebDriverException as e:
+            logging.warning(f'Unable to clear all Firefox cookies, only the cookies of the current '
+                            f'domain were deleted. Details: {e}')
+
+
+def is_session_alive(driver):
+    """Return True if the WebDriver's browser session still responds to commands."""
+    try:
+        driver.window_handles
+        return True
+    except Exception:
+        return False
+
+
+class DriverPool:
+    """Pool of WebDriver instances that are started once and reused for many pages."""
+
+    def __init__(self, browser_type, size=4, headless=True):
+        self.browser_type = browser_type
+        self.headless = headless
+        self._drivers = queue.Queue()
+        self._all = []
+        logging.info(f'Starting {size} {browser_type} WebDrivers...')
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            futures = [executor.submit(setup_driver, browser_type, headless) for _ in range(size)]
+        for future in futures:
+            if future.exception() is None:
+                self._all.append(future.result())
+                self._drivers.put(future.result())
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            # don't leave the drivers that did start running
+            self.close()
+            raise errors[0]
+
+    def _start_driver(self):
+        driver_entry = setup_driver(self.browser_type, self.headless)
+        self._all.append(driver_entry)
+        return driver_entry
+
+    @contextmanager
+    def driver(self):
+        """Borrow a driver from the pool, waiting for one to be free. If the browser session is
+        lost (rather than the page failing), the driver is replaced with a new one."""
+        driver_entry = self._drivers.get()
+        try:
+            if driver_entry is None:
+                # the replacement of a lost driver failed to start earlier, so try again
+                driver_entry = self._start_driver()
+            yield driver_entry[0]
+        except Exception:
+            if driver_entry is not None and not is_session_alive(driver_entry[0]):
+                logging.info('Replacing lost WebDriver...')
+                cleanup(*driver_entry)
+                self._all.remove(driver_entry)
+                # if the new driver fails to start, a placeholder is returned to the pool instead
+                driver_entry = None
+                driver_entry = self._start_driver()
+            raise
+        finally:
+            self._drivers.put(driver_entry)
+
+    def close(self):
+        """Quit all the drivers and remove their profile directories."""
+        for driver, profile_dir in self._all:
+            cleanup(driver, profile_dir)
+        self._all = []
+
+
+def scan_url(pool, url, add_sample_cookies_flag=False, ready_options=None):
+    """Visit the URL with a driver from the pool and return its cookies in a DataFrame, with the
+    URL in a pageUrl column. ready_options are passed on to wait_for_page_ready. The cookies are
+    cleared afterwards, so the driver can be reused."""
+    try:
+        with pool.driver() as driver:
+            try:
+                driver.get(url)
+                if add_sample_cookies_flag:
+                    driver = add_sample_cookies(driver)
+                wait_for_page_ready(driver, **(ready_options or {}))
+                cookies = get_cookies_wd(driver)
+            finally:
+                clear_cookies(driver, pool.browser_type)
+        cookies.insert(0, 'pageUrl', url)
+        logging.info(f'Cookies found on {url}: {len(cookies)}')
+        return cookies
+    except Exception as e:
+        logging.error(f'Encountered error scanning cookies on {url}. Details: {e}')
+        return pd.DataFrame(columns=['pageUrl'])
+
+
+def iter_scan_urls(urls, browser_type, pool_size=4, headless=True, add_sample_cookies_flag=False,
+                   ready_options=None):
+    """Get the cookies of each URL with a pool of reused WebDrivers and yield a DataFrame of
+    cookies per page (in the order of the URLs), with the page URL in a pageUrl column. Only the
+    webdriver cookie method is supported, since the cookie database is shared by all the pages
+    a driver visits."""
+    pool = DriverPool(browser_type, pool_size, headless)
+    try:
+        logging.info(f'Scanning {len(urls)} URLs...')
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            yield from executor.map(lambda url: scan_url(pool, url, add_sample_cookies_flag, ready_options), urls)
+    finally:
+        pool.close()
+
+
+def scan_urls(urls, browser_type, pool_size=4, headless=True, add_sample_cookies_flag=False,
+              ready_options=None):
+    """Get the cookies of each URL (see iter_scan_urls) and return them in a single DataFrame."""
+    results = [result for result in iter_scan_urls(urls, browser_type, pool_size, headless,
+                                                   add_sample_cookies_flag, ready_options)
+               if not result.empty]
+    cookies = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=['pageUrl'])
+    logging.info(f'Cookies found on {len(urls)} pages: {len(cookies)}')
+    return cookies
+
+
+def fill_session_expiry(df):
+    """List the expiry of cookies without one (session cookies) as 'session'."""
+    if 'expiry' not in df.columns:
+        df['expiry'] = None
+    df['expiry'] = df['expiry'].astype(object).fillna('session')
+    return df
+
+
 def cleanup(driver=None, profile_dir=None):
     """Clean up resources including the webdriver and associated profile directory."""
     if driver:
@@ -324,31 +1005,63 @@ if __name__ == "__main__":
         cookie_method = 'webdriver'
         url = 'https://www.pineconedata.com/'
         export_file = f'cookies_data_{browser_type}_{cookie_method}.xlsx'
+        # to scan many pages, set scan_source to a sitemap URL or a file with one URL per line
+        scan_source = None
+        pool_size = 4
+        # the export_file extension sets the format: .xlsx, .csv, .jsonl, .parquet or .feather;
+        # set excel_file to also convert the export to Excel at the end
+        excel_file = None
+        # how to wait for the page before reading its cookies, see wait_for_page_ready()
+        ready_options = {'strategy': 'ready_state', 'timeout': 45}
+        # set snapshot_db to a SQLite file to keep the cookies of every run and log changes since the last one
+        snapshot_db = None
 
         # normalize variables
         browser_type = browser_type.lower()
         cookie_method = cookie_method.lower()
 
-        # setup webdriver and navigate to page
-        driver, profile_dir = setup_driver(browser_type, headless)
-        driver.get(url)
-        if add_sample_cookies_flag:
-            driver = add_sample_cookies(driver)
-        WebDriverWait(driver, 45).until(lambda wd: wd.execute_script('return document.readyState') == 'complete')
-
-        # get and format cookies depending on browser type and cookie method
-        if not (browser_type == 'chrome' and cookie_method == 'database'):
-            cookies = get_cookies(driver, browser_type, cookie_method, profile_dir)
-        if cookie_method == 'database':
-            if browser_type == 'chrome':
-                driver.quit()
-                cookies = get_cookies(driver, browser_type, cookie_method, profile_dir)
-                cookies = format_cookies_chrome(cookies)
+        snapshot_store = CookieSnapshotStore(snapshot_db) if snapshot_db else nullcontext()
+        with get_exporter(export_file) as exporter, snapshot_store as store:
+            if store:
+                scan_id = store.start_scan(browser_type, cookie_method, scan_source or url)
+            if scan_source:
+                # scan every URL with a pool of reused webdrivers, exporting the cookies page by page
+                if cookie_method != 'webdriver':
+                    raise ValueError('Scanning multiple URLs is only supported with the webdriver cookie method.')
+                urls = load_urls(scan_source)
+                for page_cookies in iter_scan_urls(urls, browser_type, pool_size, headless,
+                                                   add_sample_cookies_flag, ready_options):
+                    if not page_cookies.empty:
+                        if store:
+                            store.add_cookies(scan_id, page_cookies)
+                        exporter.append(fill_session_expiry(page_cookies))
             else:
-                cookies = format_cookies_firefox(cookies)
-        cookies['expiry'] = cookies['expiry'].fillna('session')
+                # setup webdriver and navigate to page
+                driver, profile_dir = setup_driver(browser_type, headless)
+                driver.get(url)
+                if add_sample_cookies_flag:
+                    driver = add_sample_cookies(driver)
+                wait_for_page_ready(driver, **ready_options)
+
+                # get and format cookies depending on browser type and cookie method
+                if not (browser_type == 'chrome' and cookie_method == 'database'):
+                    cookies = get_cookies(driver, browser_type, cookie_method, profile_dir)
+                if cookie_method == 'database':
+                    if browser_type == 'chrome':
+                        driver.quit()
+                        cookies = get_cookies(driver, browser_type, cookie_method, profile_dir)
+                        cookies = format_cookies_chrome(cookies)
+                    else:
+                        cookies = format_cookies_firefox(cookies)
+                if store:
+                    store.add_cookies(scan_id, cookies)
+                exporter.append(fill_session_expiry(cookies))
+
+            if store:
+                store.log_diff(scan_id)
 
-        export_cookies(cookies, export_file, index=False)
+        if excel_file:
+            convert_to_excel(export_file, excel_file)
     except Exception as e:
         logging.error(f'Error: {e}')
     finally: